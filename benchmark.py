@@ -0,0 +1,332 @@
+"""
+Offline benchmark for a full calendar + backlog cycle.
+
+Starts a local stand-in for Sonarr, Torrentio, Real-Debrid and Jellyfin with synthetic data,
+points main.py at it and runs full cycles at different library sizes.
+Wall time, request counts and peak memory are printed and saved as JSON so runs of
+different versions can be compared.
+
+    python benchmark.py --sizes 100 1000 10000 --latency 0.01 --output bench.json
+    python benchmark.py --compare bench.json
+"""
+import argparse
+import asyncio
+import contextlib
+import http.server
+import io
+import json
+import os
+import platform
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlsplit, parse_qs
+
+QUALITY_PROFILE = {
+    "id": 1,
+    "name": "HD-1080p",
+    "items": [
+        {"allowed": False, "items": [], "quality": {"name": "HDTV-720p"}},
+        {"allowed": True, "items": [], "quality": {"name": "WEBDL-1080p"}},
+        {"allowed": True, "items": [], "quality": {"name": "Bluray-1080p"}},
+    ],
+}
+
+
+def make_episodes(count, episodes_per_season):
+    """
+    Build a synthetic calendar of aired episodes, episodes_per_season episodes per show.
+    """
+    aired = datetime.now(timezone.utc) - timedelta(hours=6)
+    episodes = []
+    for index in range(count):
+        show = index // episodes_per_season
+        episodes.append({
+            "id": index + 1,
+            "seasonNumber": 1,
+            "episodeNumber": index % episodes_per_season + 1,
+            "airDateUtc": aired.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "hasFile": False,
+            "monitored": True,
+            "series": {
+                "id": show + 1,
+                "title": f"Show {show + 1}",
+                "imdbId": f"tt{show + 1:07d}",
+                "qualityProfileId": 1,
+                "path": f"/tv/Show {show + 1}",
+            },
+        })
+    return episodes
+
+
+def make_streams(imdb_id, season, episode, count):
+    """
+    Build synthetic Torrentio streams for an episode, with a mix of qualities, languages and a season pack.
+    """
+    streams = []
+    for index in range(count):
+        quality = ("1080p WEB-DL", "2160p HDR WEB-DL", "720p HDTV", "1080p BluRay")[index % 4]
+        flags = " / 🇮🇹" if index % 5 == 4 else ""
+        name = f"Show.S{season:02d}E{episode:02d}.{quality.replace(' ', '.')}.x264"
+        streams.append({
+            "name": f"Torrentio\n{quality.split()[0]}",
+            "title": f"{name}\n👤 {(count - index) * 7} 💾 {1 + index % 3}.{index % 10} GB ⚙️ Bench{flags}",
+            "infoHash": f"{imdb_id}{season:02d}{episode:03d}{index:04d}".lower().ljust(40, "0"),
+        })
+    streams.append({
+        "name": "Torrentio\n1080p",
+        "title": f"Show.S{season:02d}.1080p.WEB-DL.x264\nShow.S{season:02d}E{episode:02d}.mkv\n👤 3 💾 20.0 GB ⚙️ Bench",
+        "infoHash": f"{imdb_id}{season:02d}pack".lower().ljust(40, "0"),
+    })
+    return streams
+
+
+class FakeServices:
+    """
+    Stand-in for Sonarr v3, Torrentio, Real-Debrid and Jellyfin on one local port.
+    """
+
+    def __init__(self, episodes, streams_per_episode=20, latency=0.0):
+        self.episodes = {episode["id"]: episode for episode in episodes}
+        self.streams_per_episode = streams_per_episode
+        self.latency = latency
+        self.counts = {}
+        self.lock = threading.Lock()
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), self.make_handler())
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def count(self, route):
+        with self.lock:
+            self.counts[route] = self.counts.get(route, 0) + 1
+
+    def reset_counts(self):
+        with self.lock:
+            counts, self.counts = self.counts, {}
+        return counts
+
+    def calendar(self, query):
+        start = query.get("start", [None])[0]
+        end = query.get("end", [None])[0]
+        return [
+            episode for episode in self.episodes.values()
+            if (start is None or episode["airDateUtc"] >= start) and (end is None or episode["airDateUtc"] < end)
+        ]
+
+    def route(self, method, path, query):
+        """
+        Return (route name, status, body) for a request.
+        """
+        if method == "GET" and path == "/api/v3/calendar":
+            return "sonarr calendar", 200, self.calendar(query)
+        match = re.fullmatch(r"/api/v3/episode/(\d+)", path)
+        if method == "GET" and match:
+            return "sonarr episode", 200, self.episodes[int(match.group(1))]
+        if method == "GET" and path == "/api/v3/episode":
+            series_id = int(query["seriesId"][0])
+            return "sonarr episode", 200, [e for e in self.episodes.values() if e["series"]["id"] == series_id]
+        if method == "GET" and re.fullmatch(r"/api/v3/qualityprofile/\d+", path):
+            return "sonarr qualityprofile", 200, QUALITY_PROFILE
+        match = re.search(r"/stream/series/(tt\d+):(\d+):(\d+)\.json$", path)
+        if method == "GET" and match:
+            imdb_id, season, episode = match.group(1), int(match.group(2)), int(match.group(3))
+            return "torrentio stream", 200, {"streams": make_streams(imdb_id, season, episode, self.streams_per_episode)}
+        if method == "GET" and path.startswith("/rest/1.0/torrents/instantAvailability/"):
+            hashes = path.rsplit("/instantAvailability/", 1)[1].split("/")
+            return "rd instantAvailability", 200, {h: {"rd": [{"1": {}}]} if h.endswith("0") else [] for h in hashes}
+        if method == "POST" and path == "/rest/1.0/torrents/addMagnet":
+            return "rd addMagnet", 201, {"id": f"RD{time.monotonic_ns()}", "uri": "/torrents/info/x"}
+        if method == "POST" and path.startswith("/rest/1.0/torrents/selectFiles/"):
+            return "rd selectFiles", 204, None
+        if method == "GET" and path.startswith("/rest/1.0/torrents/info/"):
+            return "rd info", 200, {"id": path.rsplit("/", 1)[1], "filename": "bench", "status": "downloaded", "files": []}
+        if method == "POST" and path.startswith("/Library/") or method == "POST" and path.startswith("/Items/"):
+            return "jellyfin refresh", 204, None
+        if method == "GET" and path.startswith("/library/sections"):
+            return "plex refresh", 200, None
+        return "unknown", 404, None
+
+    def make_handler(self):
+        services = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def handle_request(self, method):
+                url = urlsplit(self.path)
+                length = int(self.headers.get("Content-Length", 0) or 0)
+                if length:
+                    self.rfile.read(length)
+                if services.latency:
+                    time.sleep(services.latency)
+                route, status, body = services.route(method, url.path, parse_qs(url.query))
+                services.count(route)
+                payload = b"" if body is None else json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_GET(self):
+                self.handle_request("GET")
+
+            def do_POST(self):
+                self.handle_request("POST")
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def configure_environment(port, workdir):
+    """
+    Point main.py at the local stand-in. Has to happen before main is imported.
+    main loads .env without overriding what's already set, so anything there that would send requests
+    somewhere else or change what a cycle does is switched off here.
+    """
+    base = f"http://127.0.0.1:{port}"
+    os.environ.update({
+        "SONARR_INSTANCES": "",
+        "API_KEY": "bench",
+        "HOST": "127.0.0.1",
+        "PORT": str(port),
+        "TORRENTIO_URL": base,
+        "DEBRID_URL": base,
+        "DEBRID_KEY": "bench",
+        "JELLYFIN": "true",
+        "JELLYFIN_HOST": "127.0.0.1",
+        "JELLYFIN_PORT": str(port),
+        "JELLYFIN_API_TOKEN": "bench",
+        "PLEX": "false",
+        "RD_MOUNT_PATH": "",
+        "METRICS_LOG": "",
+        "METRICS_PORT": "0",
+        "WEBHOOK_PORT": "0",
+        "DRY_RUN": "false",
+        "BANNED_WORDS": '["/ 🇮🇹"]',
+        "HDR_MODE": "false",
+        "RD_REQUESTS_PER_MINUTE": "1000000",
+        # Search the whole backlog in one cycle so runs of different sizes are comparable
+        "BACKLOG_REQUEST_BUDGET": "0",
+        "DB_PATH": os.path.join(workdir, "bench.db"),
+    })
+
+
+def run_size(main, services, size, episodes_per_season, workdir):
+    """
+    Run one full cycle against a fresh store with the given number of episodes.
+    """
+    services.episodes = {episode["id"]: episode for episode in make_episodes(size, episodes_per_season)}
+    main.close_stores()
+    main.DB_PATH = os.path.join(workdir, f"bench-{size}.db")
+    main.refresh_profile_cache()
+    main._availability_cache.clear()
+    services.reset_counts()
+    sent_before = main.get_metric("episodes_total", stage="sent")
+
+    tracemalloc.start()
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        asyncio.run(main.run_once(main.ONE_SHOT_JOBS["run-once"]))
+    wall_time = time.perf_counter() - started
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    requests = services.reset_counts()
+    return {
+        "episodes": size,
+        "wall_time_s": round(wall_time, 3),
+        "episodes_per_s": round(size / wall_time, 1) if wall_time else None,
+        "episodes_sent": main.get_metric("episodes_total", stage="sent") - sent_before,
+        "requests": dict(sorted(requests.items())),
+        "total_requests": sum(requests.values()),
+        "peak_memory_mb": round(peak / (1024 * 1024), 2),
+    }
+
+
+def git_version():
+    """
+    The commit being benchmarked, so saved results say which version they came from.
+    """
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path):
+    """
+    Print how the results compare with a previously saved run.
+    """
+    with open(baseline_path) as file:
+        baseline = {run["episodes"]: run for run in json.load(file)["runs"]}
+    print(f"\nCompared with {baseline_path}:")
+    for run in results["runs"]:
+        old = baseline.get(run["episodes"])
+        if old is None:
+            continue
+        for key in ("wall_time_s", "total_requests", "peak_memory_mb"):
+            change = (run[key] - old[key]) / old[key] * 100 if old[key] else 0
+            print(f"  {run['episodes']:>6} episodes {key:<15} {old[key]:>10} -> {run[key]:>10} ({change:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark full cycles against a local Sonarr/Torrentio/Real-Debrid stand-in.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000], help="episode counts to run")
+    parser.add_argument("--latency", type=float, default=0.005, help="seconds added to every fake request")
+    parser.add_argument("--streams", type=int, default=20, help="Torrentio streams per episode")
+    parser.add_argument("--episodes-per-season", type=int, default=1, help="episodes per show, more than 2 exercises season packs")
+    parser.add_argument("--output", default="benchmark_results.json", help="where to save the results")
+    parser.add_argument("--compare", help="saved results to compare against")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        services = FakeServices([], args.streams, args.latency)
+        configure_environment(services.port, workdir)
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        import main as app
+
+        results = {
+            "version": git_version(),
+            "time": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "python": platform.python_version(),
+            "latency_s": args.latency,
+            "streams_per_episode": args.streams,
+            "episodes_per_season": args.episodes_per_season,
+            "runs": [],
+        }
+        try:
+            for size in args.sizes:
+                run = run_size(app, services, size, args.episodes_per_season, workdir)
+                results["runs"].append(run)
+                print(f"{size:>6} episodes: {run['wall_time_s']}s, {run['total_requests']} requests, "
+                      f"{run['episodes_sent']} sent, peak {run['peak_memory_mb']} MB")
+        finally:
+            app.close_connections()
+            app.close_stores()
+            services.close()
+
+    with open(args.output, "w") as file:
+        json.dump(results, file, indent=4)
+    print(f"Saved results to {args.output}")
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,280 +3,2039 @@ from dotenv import load_dotenv
 import os
 import asyncio
 import json
-from datetime import datetime
-import pytz
+from datetime import datetime, timedelta, timezone
 import traceback
 import threading
-import sys
-from codecs import encode
+from codecs import encode, getincrementaldecoder
 import time
 import re
 import itertools
+import heapq
+import math
+import hashlib
+from collections import namedtuple
+import weakref
+import random
+import signal
+import select
+from urllib.parse import urlsplit, parse_qs, quote
+import sqlite3
 
 # Load environment variables
 load_dotenv()
 
+def parse_server_url(url):
+    """
+    Split a service URL like https://torrentio.strem.fun into (host, port, secure).
+    """
+    parts = urlsplit(url)
+    return parts.hostname, parts.port, parts.scheme == "https"
+
+# Torrentio and Real-Debrid can be pointed somewhere else, eg a local stand-in for benchmarks
+TORRENTIO_SERVER = parse_server_url(os.getenv("TORRENTIO_URL", "https://torrentio.strem.fun"))
+DEBRID_SERVER = parse_server_url(os.getenv("DEBRID_URL", "https://api.real-debrid.com"))
+
+# How many requests we allow in flight against each remote service at once
+HOST_LIMITS = {
+    "sonarr": int(os.getenv("SONARR_CONCURRENCY", 4)),
+    "torrentio": int(os.getenv("TORRENTIO_CONCURRENCY", 4)),
+    "debrid": int(os.getenv("DEBRID_CONCURRENCY", 2)),
+    "library": 1,
+}
+# How many episodes are worked on at the same time
+MAX_WORKERS = int(os.getenv("MAX_WORKERS", 8))
+
+# Semaphores belong to an event loop, so keep one set per running loop
+_host_semaphores = weakref.WeakKeyDictionary()
+
+# Keep-alive connections waiting to be reused, per (secure, host, port)
+POOL_MAX_IDLE = int(os.getenv("POOL_MAX_IDLE", 4))
+# Servers drop keep-alive connections nobody uses, so ones idle longer than this are closed instead of reused.
+# Requests that can't safely be resent only reuse a connection that was in use moments ago
+POOL_IDLE_TIMEOUT = float(os.getenv("POOL_IDLE_TIMEOUT", 30))
+POOL_NON_IDEMPOTENT_IDLE = 2
+_idle_connections = {}
+_pool_stats = {}
+_pool_lock = threading.Lock()
+
+# How far back the first calendar sync reads. Later syncs start from where the last one finished,
+# going back CALENDAR_SYNC_OVERLAP seconds to catch air dates Sonarr moved. Fetched in windows of CALENDAR_WINDOW_DAYS
+CALENDAR_PAST_DAYS = int(os.getenv("CALENDAR_PAST_DAYS", 1))
+CALENDAR_SYNC_OVERLAP = int(os.getenv("CALENDAR_SYNC_OVERLAP", 6 * 3600))
+CALENDAR_WINDOW_DAYS = int(os.getenv("CALENDAR_WINDOW_DAYS", 7))
+# Fields an inline calendar entry needs before we can skip fetching the episode on its own
+CALENDAR_REQUIRED_FIELDS = ("id", "seasonNumber", "episodeNumber", "airDateUtc")
+CALENDAR_REQUIRED_SERIES_FIELDS = ("title", "qualityProfileId")
+# A calendar entry is only looked at again when one of these changes
+CALENDAR_FINGERPRINT_FIELDS = ("airDateUtc", "hasFile", "monitored", "lastSearchTime")
+
+# Port for the Sonarr webhook listener, off unless set. With webhooks on, polling is only a fallback
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 0))
+WEBHOOK_TOKEN = os.getenv("WEBHOOK_TOKEN")
+POLL_INTERVAL = int(os.getenv("POLL_INTERVAL", 3600 if WEBHOOK_PORT else 600))
+# The calendar refresh and backlog search can run on their own intervals
+CALENDAR_INTERVAL = int(os.getenv("CALENDAR_INTERVAL", POLL_INTERVAL))
+BACKLOG_INTERVAL = int(os.getenv("BACKLOG_INTERVAL", POLL_INTERVAL))
+# fixed-rate keeps runs on a steady beat, fixed-delay waits the interval after each run finishes
+SCHEDULE_MODE = os.getenv("SCHEDULE_MODE", "fixed-rate")
+# Up to this many seconds are added to each wait so runs don't line up with other tools
+SCHEDULE_JITTER = float(os.getenv("SCHEDULE_JITTER", 0))
+# How long shutdown waits for Real-Debrid submissions that are already under way
+SHUTDOWN_TIMEOUT = float(os.getenv("SHUTDOWN_TIMEOUT", 30))
+# Search and rank as usual but don't send anything to Real-Debrid, also set by --dry-run
+DRY_RUN = os.getenv("DRY_RUN", "false") == "true"
+
+# Append structured JSON logs to this file ("-" for stdout), off unless set
+METRICS_LOG = os.getenv("METRICS_LOG")
+# Serve /metrics on its own port when the webhook listener isn't running
+METRICS_PORT = int(os.getenv("METRICS_PORT", 0))
+# Histogram buckets in seconds, shared by request and cycle timings
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+METRIC_HELP = {
+    "http_request_duration_seconds": ("histogram", "Time taken by requests to each service endpoint"),
+    "http_requests_total": ("counter", "Requests made to each service endpoint by status"),
+    "http_connections_total": ("counter", "Pooled connections opened, reused, retried and dropped per host"),
+    "cycle_duration_seconds": ("histogram", "Time taken by a full calendar and backlog cycle"),
+    "cycle_episodes": ("gauge", "Episodes processed, matched and sent in the last cycle"),
+    "episodes_total": ("counter", "Episodes processed, matched and sent since startup"),
+    "cache_requests_total": ("counter", "Cache lookups by cache and result"),
+    "queue_depth": ("gauge", "Items waiting in each work queue"),
+    "calendar_entries_total": ("counter", "Calendar entries synced, by whether they changed since they were last seen"),
+    "duplicates_skipped_total": ("counter", "Work skipped because the same episode or infoHash was already in flight or sent"),
+}
+_metrics = {}
+_metrics_lock = threading.Lock()
+
+# Where the watch list lives. data.json is only used to import/export it now
+DB_PATH = os.getenv("DB_PATH", "data.db")
+# Sonarr instance used when SONARR_INSTANCES isn't set, and that episodes stored before instances existed belong to
+DEFAULT_INSTANCE = "default"
+# Steps an episode goes through on its way to RD, in order. Each one is committed before the next network call starts:
+# queued: on the watch list, waiting to be searched
+# searching: a torrent was picked and its magnet recorded, it's being added to RD
+# submitted: RD added the torrent, its id is recorded
+# files_selected: the download was started on RD
+# done: taken off the watch list (has_downloaded)
+EPISODE_STATES = ("queued", "searching", "submitted", "files_selected", "done")
+
+# Each entry upgrades the store by one version, tracked with PRAGMA user_version
+STORE_MIGRATIONS = [
+    """
+    CREATE TABLE IF NOT EXISTS episodes (
+        id INTEGER PRIMARY KEY,
+        has_downloaded INTEGER NOT NULL DEFAULT 0,
+        data TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS episodes_pending ON episodes (has_downloaded);
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS torrentio_cache (
+        key TEXT PRIMARY KEY,
+        body TEXT NOT NULL,
+        expires_at REAL NOT NULL,
+        empty_streak INTEGER NOT NULL DEFAULT 0,
+        last_used REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS torrentio_cache_lru ON torrentio_cache (last_used);
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS submitted_hashes (
+        info_hash TEXT NOT NULL,
+        episode_id INTEGER NOT NULL,
+        submitted_at REAL NOT NULL,
+        PRIMARY KEY (info_hash, episode_id)
+    );
+    CREATE INDEX IF NOT EXISTS submitted_hashes_episode ON submitted_hashes (episode_id);
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS sync_state (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS calendar_seen (
+        episode_id INTEGER PRIMARY KEY,
+        fingerprint TEXT NOT NULL,
+        air_date TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS calendar_seen_air_date ON calendar_seen (air_date);
+    """,
+    # Sonarr ids are only unique per instance, so the instance becomes part of every episode key
+    """
+    CREATE TABLE episodes_by_instance (
+        instance TEXT NOT NULL,
+        id INTEGER NOT NULL,
+        has_downloaded INTEGER NOT NULL DEFAULT 0,
+        data TEXT NOT NULL,
+        PRIMARY KEY (instance, id)
+    );
+    INSERT INTO episodes_by_instance (instance, id, has_downloaded, data)
+        SELECT 'default', id, has_downloaded, data FROM episodes ORDER BY rowid;
+    DROP TABLE episodes;
+    ALTER TABLE episodes_by_instance RENAME TO episodes;
+    CREATE INDEX episodes_pending ON episodes (has_downloaded);
+
+    CREATE TABLE submitted_by_instance (
+        info_hash TEXT NOT NULL,
+        instance TEXT NOT NULL,
+        episode_id INTEGER NOT NULL,
+        submitted_at REAL NOT NULL,
+        PRIMARY KEY (info_hash, instance, episode_id)
+    );
+    INSERT INTO submitted_by_instance (info_hash, instance, episode_id, submitted_at)
+        SELECT info_hash, 'default', episode_id, submitted_at FROM submitted_hashes;
+    DROP TABLE submitted_hashes;
+    ALTER TABLE submitted_by_instance RENAME TO submitted_hashes;
+    CREATE INDEX submitted_hashes_episode ON submitted_hashes (instance, episode_id);
+
+    CREATE TABLE calendar_seen_by_instance (
+        instance TEXT NOT NULL,
+        episode_id INTEGER NOT NULL,
+        fingerprint TEXT NOT NULL,
+        air_date TEXT NOT NULL,
+        PRIMARY KEY (instance, episode_id)
+    );
+    INSERT INTO calendar_seen_by_instance (instance, episode_id, fingerprint, air_date)
+        SELECT 'default', episode_id, fingerprint, air_date FROM calendar_seen;
+    DROP TABLE calendar_seen;
+    ALTER TABLE calendar_seen_by_instance RENAME TO calendar_seen;
+    CREATE INDEX calendar_seen_air_date ON calendar_seen (air_date);
+
+    UPDATE sync_state SET key = key || ':default' WHERE key = 'calendar_synced_until';
+    """,
+    # What the backlog is ordered by, see load_backlog
+    """
+    ALTER TABLE episodes ADD COLUMN aired_at REAL;
+    ALTER TABLE episodes ADD COLUMN failures INTEGER NOT NULL DEFAULT 0;
+    ALTER TABLE episodes ADD COLUMN last_searched REAL;
+    ALTER TABLE episodes ADD COLUMN next_search REAL NOT NULL DEFAULT 0;
+    UPDATE episodes SET aired_at = CAST(strftime('%s', json_extract(data, '$.airDateUtc')) AS REAL);
+    CREATE INDEX episodes_backlog ON episodes (has_downloaded, next_search);
+    """,
+    # Journal of how far each episode got in being sent to RD, see EPISODE_STATES
+    """
+    ALTER TABLE episodes ADD COLUMN state TEXT NOT NULL DEFAULT 'queued';
+    ALTER TABLE episodes ADD COLUMN magnet TEXT;
+    ALTER TABLE episodes ADD COLUMN torrent_id TEXT;
+    UPDATE episodes SET state = 'done' WHERE has_downloaded = 1;
+    CREATE INDEX episodes_state ON episodes (state);
+    """,
+]
+
+_stores = {}
+_store_lock = threading.RLock()
+# db_path -> set of downloaded (instance, episode id) keys, loaded the first time it's needed
+_downloaded_ids = {}
+# How long a hash we sent to RD is remembered, so it isn't sent again after a restart
+SUBMITTED_HASH_TTL = int(os.getenv("SUBMITTED_HASH_TTL", 7 * 86400))
+
+# How long Torrentio answers are reused. Empty answers start at TORRENTIO_EMPTY_TTL and
+# double every time they come back empty again, up to TORRENTIO_EMPTY_MAX_TTL
+TORRENTIO_CACHE_TTL = int(os.getenv("TORRENTIO_CACHE_TTL", 3600))
+TORRENTIO_EMPTY_TTL = int(os.getenv("TORRENTIO_EMPTY_TTL", 1800))
+TORRENTIO_EMPTY_MAX_TTL = int(os.getenv("TORRENTIO_EMPTY_MAX_TTL", 86400))
+TORRENTIO_CACHE_SIZE = int(os.getenv("TORRENTIO_CACHE_SIZE", 5000))
+# Only the best TORRENTIO_TOP_K streams that pass the filters are kept per episode, the rest are dropped as they're parsed
+TORRENTIO_TOP_K = int(os.getenv("TORRENTIO_TOP_K", 20))
+# Bytes read from a response at a time when it's parsed as it arrives
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Real-Debrid allows 250 requests a minute. Requests past that wait their turn, 429s are retried
+RD_REQUESTS_PER_MINUTE = int(os.getenv("RD_REQUESTS_PER_MINUTE", 250))
+RD_MAX_RETRIES = int(os.getenv("RD_MAX_RETRIES", 5))
+_debrid_rate = {"next_slot": 0.0, "blocked_until": 0.0}
+# Check whether RD already has the best few candidates cached, and prefer the ones it does
+RD_INSTANT_AVAILABILITY = os.getenv("RD_INSTANT_AVAILABILITY", "true") == "true"
+RD_AVAILABILITY_TOP_N = int(os.getenv("RD_AVAILABILITY_TOP_N", 5))
+RD_AVAILABILITY_TTL = int(os.getenv("RD_AVAILABILITY_TTL", 3600))
+# infoHash -> (expires, cached)
+_availability_cache = {}
+
+# When at least SEASON_PACK_MIN_EPISODES of a season are missing, look for a season pack that
+# covers SEASON_PACK_MIN_COVERAGE of them and send that instead of one torrent per episode
+SEASON_PACK_MIN_EPISODES = int(os.getenv("SEASON_PACK_MIN_EPISODES", 3))
+SEASON_PACK_MIN_COVERAGE = float(os.getenv("SEASON_PACK_MIN_COVERAGE", 0.75))
+
+# How much each feature counts when the streams that passed the filters are scored, see score_candidates.
+# STREAM_SCORE_WEIGHTS overrides some or all of them, eg {"size": 0}
+DEFAULT_SCORE_WEIGHTS = {"preference": 4, "seeders": 3, "resolution": 1, "source": 1, "size": 1}
+
+def load_score_weights(value):
+    """
+    Read STREAM_SCORE_WEIGHTS on top of the defaults. Anything but a JSON object of numbers
+    for the known features is ignored with a warning, rather than stopping us at startup.
+    """
+    try:
+        weights = json.loads(value or "{}")
+        if not isinstance(weights, dict) or set(weights) - set(DEFAULT_SCORE_WEIGHTS):
+            raise ValueError(f"expected a JSON object with any of {', '.join(DEFAULT_SCORE_WEIGHTS)}")
+        if not all(isinstance(weight, (int, float)) and not isinstance(weight, bool) for weight in weights.values()):
+            raise ValueError("weights have to be numbers")
+    except ValueError as e:
+        print(f"Ignoring STREAM_SCORE_WEIGHTS, using the defaults: {e}")
+        return dict(DEFAULT_SCORE_WEIGHTS)
+    return {**DEFAULT_SCORE_WEIGHTS, **weights}
+
+STREAM_SCORE_WEIGHTS = load_score_weights(os.getenv("STREAM_SCORE_WEIGHTS"))
+
+# How long a quality profile is trusted before we ask Sonarr whether it changed
+PROFILE_CACHE_TTL = int(os.getenv("PROFILE_CACHE_TTL", 3600))
+
+# A backlog search stops starting new episodes once it has made BACKLOG_REQUEST_BUDGET Torrentio requests (0 for no limit).
+# Each search that finds nothing counts against the episode and pushes it back by BACKLOG_FAILURE_WEIGHT days of air date.
+# After BACKLOG_SLOW_AFTER failures in a row it moves to the slow lane and is only searched every BACKLOG_SLOW_INTERVAL seconds
+BACKLOG_REQUEST_BUDGET = int(os.getenv("BACKLOG_REQUEST_BUDGET", 500))
+BACKLOG_FAILURE_WEIGHT = int(os.getenv("BACKLOG_FAILURE_WEIGHT", 7))
+BACKLOG_SLOW_AFTER = int(os.getenv("BACKLOG_SLOW_AFTER", 5))
+BACKLOG_SLOW_INTERVAL = int(os.getenv("BACKLOG_SLOW_INTERVAL", 86400))
+
+# Media servers are refreshed per series folder once no new torrent has come in for it for LIBRARY_REFRESH_DEBOUNCE seconds
+# and its files show up under RD_MOUNT_PATH. After LIBRARY_MOUNT_TIMEOUT seconds we stop waiting for the mount
+RD_MOUNT_PATH = os.getenv("RD_MOUNT_PATH")
+LIBRARY_REFRESH_DEBOUNCE = int(os.getenv("LIBRARY_REFRESH_DEBOUNCE", 60))
+LIBRARY_MOUNT_TIMEOUT = int(os.getenv("LIBRARY_MOUNT_TIMEOUT", 1800))
+LIBRARY_CHECK_INTERVAL = 5
+# Series path (None for a full refresh) -> {"quiet_at", "deadline", "files"} for refreshes still to go out
+_pending_refreshes = {}
+# (instance, qualityProfileId) -> {"terms", "preference", "etag", "expires"}
+_profile_cache = {}
+# Per loop locks so only one request per profile is in flight at a time
+_loop_locks = weakref.WeakKeyDictionary()
+
 def set_env():
     """
-    Load API key, host, and port from environment variables.
-    Returns the API key, host, and port as a tuple.
+    Load API key, host, and port from environment variables.
+    Returns the API key, host, and port as a tuple.
+    """
+    api_key = os.getenv("API_KEY")
+    host = os.getenv("HOST", "127.0.0.1")
+    port = int(os.getenv("PORT", 8989))
+    return api_key, host, port
+
+def connect_http(host, port):
+    """
+    Create and return an HTTP connection to the specified host and port.
+    """
+    return http.client.HTTPConnection(host, port)
+
+def send_request(api_key, conn, endpoint, headers=None):
+    """
+    Send a GET request to the specified endpoint with the given API key.
+    """
+    separator = '&' if '?' in endpoint else '?'
+    if headers:
+        conn.request("GET", f"{endpoint}{separator}apikey={api_key}", '', headers)
+    else:
+        conn.request("GET", f"{endpoint}{separator}apikey={api_key}", '')
+
+def get_response(conn):
+    """
+    Retrieve the HTTP response from the connection and return its content.
+    """
+    return conn.getresponse().read()
+
+def connection_is_dead(conn):
+    """
+    Whether the server has closed an idle connection. An idle connection has nothing to read,
+    so a readable socket means it was closed or sent something we never asked for.
+    """
+    if conn.sock is None:
+        return True
+    try:
+        readable, _, _ = select.select([conn.sock], [], [], 0)
+    except (OSError, ValueError):
+        return True
+    return bool(readable)
+
+def checkout_connection(host, port=None, secure=False, max_idle=None):
+    """
+    Take an idle keep-alive connection to the host from the pool, or open a new one.
+    Connections idle longer than max_idle seconds, POOL_IDLE_TIMEOUT by default, or already closed by the server are dropped.
+    Returns the connection and whether it was reused.
+    """
+    key = (secure, host, port)
+    max_idle = POOL_IDLE_TIMEOUT if max_idle is None else min(max_idle, POOL_IDLE_TIMEOUT)
+    now = time.monotonic()
+    with _pool_lock:
+        stats = _pool_stats.setdefault(f"{host}:{port or (443 if secure else 80)}", {"opened": 0, "reused": 0, "retried": 0, "dropped": 0})
+        idle = _idle_connections.get(key) or []
+        while idle:
+            conn, released = idle.pop()
+            if now - released <= max_idle and not connection_is_dead(conn):
+                stats["reused"] += 1
+                return conn, True
+            conn.close()
+            stats["dropped"] += 1
+        stats["opened"] += 1
+    if secure:
+        return http.client.HTTPSConnection(host, port), False
+    return connect_http(host, port), False
+
+def release_connection(conn, host, port=None, secure=False):
+    """
+    Put a connection back in the pool so the next request to the host can reuse it.
+    """
+    with _pool_lock:
+        idle = _idle_connections.setdefault((secure, host, port), [])
+        if len(idle) < POOL_MAX_IDLE:
+            idle.append((conn, time.monotonic()))
+            return
+    conn.close()
+
+def pooled_request(host, port, send, secure=False, endpoint="other", read=None, idempotent=True):
+    """
+    Run send(conn) on a pooled connection and read the whole response.
+    A reused connection the server has already closed is retried on a fresh one. Requests that aren't idempotent,
+    like adding a torrent, are only retried if sending failed, since the server may have acted on one it didn't answer,
+    and only reuse a connection that was idle for at most POOL_NON_IDEMPOTENT_IDLE seconds.
+    The endpoint is only used to label the latency metrics.
+    read(res) can consume the response itself, eg to parse it as it arrives, and its result is returned instead of the body.
+    Returns the response object and its body.
+    """
+    started = time.monotonic()
+    status = "error"
+    try:
+        while True:
+            conn, reused = checkout_connection(host, port, secure, None if idempotent else POOL_NON_IDEMPOTENT_IDLE)
+            sent = False
+            try:
+                send(conn)
+                sent = True
+                res = conn.getresponse()
+                body = read(res) if read else res.read()
+                # Whatever the reader didn't need has to be read off before the connection can be reused
+                if not res.isclosed():
+                    res.read()
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                if not reused or (sent and not idempotent):
+                    raise
+                with _pool_lock:
+                    _pool_stats[f"{host}:{port or (443 if secure else 80)}"]["retried"] += 1
+                continue
+            except Exception:
+                # The response may be half read, so the connection can't go back in the pool
+                conn.close()
+                raise
+            status = res.status
+            if res.will_close:
+                conn.close()
+            else:
+                release_connection(conn, host, port, secure)
+            return res, body
+    finally:
+        observe("http_request_duration_seconds", time.monotonic() - started, host=host, endpoint=endpoint)
+        inc_counter("http_requests_total", host=host, endpoint=endpoint, status=status)
+
+def metric_key(name, labels):
+    """
+    Key for a metric series, the name plus its labels in a stable order.
+    """
+    return name, tuple(sorted(labels.items()))
+
+def inc_counter(name, value=1, **labels):
+    """
+    Add to a counter.
+    """
+    with _metrics_lock:
+        key = metric_key(name, labels)
+        _metrics[key] = _metrics.get(key, 0) + value
+
+def set_gauge(name, value, **labels):
+    """
+    Set a gauge to the given value.
+    """
+    with _metrics_lock:
+        _metrics[metric_key(name, labels)] = value
+
+def observe(name, value, **labels):
+    """
+    Record a value in a histogram. Stored as per bucket counts followed by the sum and count.
+    """
+    with _metrics_lock:
+        key = metric_key(name, labels)
+        series = _metrics.setdefault(key, [0] * (len(METRIC_BUCKETS) + 2))
+        for index, bound in enumerate(METRIC_BUCKETS):
+            if value <= bound:
+                series[index] += 1
+        series[-2] += value
+        series[-1] += 1
+
+def get_metric(name, **labels):
+    """
+    Current value of a counter or gauge, 0 if it was never set.
+    """
+    with _metrics_lock:
+        return _metrics.get(metric_key(name, labels), 0)
+
+def format_labels(labels):
+    """
+    Render labels the way Prometheus expects them, eg {host="x",status="200"}.
+    """
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+def render_metrics():
+    """
+    Render every metric in the Prometheus text format.
+    """
+    for host, stats in get_pool_stats().items():
+        for kind, value in stats.items():
+            set_gauge("http_connections_total", value, host=host, kind=kind)
+    with _metrics_lock:
+        # Label values can be numbers or strings (eg a status of 200 or "error"), so they're compared as text
+        series = sorted(_metrics.items(), key=lambda item: (item[0][0], [(label, str(value)) for label, value in item[0][1]]))
+    lines = []
+    described = set()
+    for (name, labels), value in series:
+        if name not in described:
+            metric_type, help_text = METRIC_HELP.get(name, ("untyped", name))
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            described.add(name)
+        if isinstance(value, list):
+            for bound, count in zip(METRIC_BUCKETS, value):
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', bound),))} {count}")
+            lines.append(f"{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {value[-1]}")
+            lines.append(f"{name}_sum{format_labels(labels)} {value[-2]}")
+            lines.append(f"{name}_count{format_labels(labels)} {value[-1]}")
+        else:
+            lines.append(f"{name}{format_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+def log_event(event, **fields):
+    """
+    Write a structured JSON log line to METRICS_LOG, if it is set.
+    """
+    if not METRICS_LOG:
+        return
+    line = json.dumps({"time": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"), "event": event, **fields})
+    if METRICS_LOG == "-":
+        print(line)
+        return
+    with open(METRICS_LOG, "a") as file:
+        file.write(line + "\n")
+
+def get_pool_stats():
+    """
+    How many connections were opened, reused, retried and dropped for being stale for each host since startup.
+    """
+    with _pool_lock:
+        return {host: dict(stats) for host, stats in _pool_stats.items()}
+
+def close_connections():
+    """
+    Close every idle pooled connection.
+    """
+    with _pool_lock:
+        for idle in _idle_connections.values():
+            for conn, _ in idle:
+                conn.close()
+        _idle_connections.clear()
+
+def sonarr_get(endpoint, headers=None, read=None, instance=None):
+    """
+    GET an endpoint from a Sonarr instance, the default one if none is given, over the shared connection pool.
+    Returns the response object and its body, or what read(res) returned.
+    """
+    sonarr = get_instance(instance)
+    label = re.sub(r"/\d+", "/{id}", endpoint.split("?")[0])
+    return pooled_request(sonarr.host, sonarr.port, lambda conn: send_request(sonarr.api_key, conn, endpoint, headers), endpoint=label, read=read)
+
+def host_semaphore(host):
+    """
+    Return the semaphore limiting concurrent requests to the given service on the running loop.
+    """
+    semaphores = _host_semaphores.setdefault(asyncio.get_running_loop(), {})
+    if host not in semaphores:
+        # Per instance hosts like "sonarr:4k" share the limit configured for "sonarr"
+        semaphores[host] = asyncio.Semaphore(HOST_LIMITS.get(host, HOST_LIMITS.get(host.split(":")[0], 1)))
+    return semaphores[host]
+
+def loop_lock(key):
+    """
+    Return an asyncio lock for the given key on the running loop.
+    """
+    locks = _loop_locks.setdefault(asyncio.get_running_loop(), {})
+    if key not in locks:
+        locks[key] = asyncio.Lock()
+    return locks[key]
+
+async def run_on_host(host, func, *args):
+    """
+    Run a blocking request function in a worker thread without going over the host's concurrency limit.
+    """
+    async with host_semaphore(host):
+        return await asyncio.to_thread(func, *args)
+
+def decode_response(response):
+    """
+    Decode the HTTP response and return it as a string.
+    """
+    return response.decode('utf-8')
+
+def read_chunks(res, size=None):
+    """
+    Yield a response body a chunk at a time.
+    """
+    while True:
+        chunk = res.read(size or STREAM_CHUNK_SIZE)
+        if not chunk:
+            return
+        yield chunk
+
+JSON_WHITESPACE = re.compile(r"[ \t\n\r]*")
+_json_decoder = json.JSONDecoder()
+
+class JsonChunkReader:
+    """
+    Decodes JSON values one at a time from chunks of bytes, reading more only when the value isn't complete yet.
+    Consumed input is dropped as it goes, so only the value being decoded is held as a string.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.decoder = getincrementaldecoder("utf-8")()
+        self.buffer = ""
+        self.pos = 0
+        self.finished = False
+
+    def fill(self):
+        """
+        Add the next chunk to the buffer. Returns False once there is nothing left to read.
+        """
+        if self.finished:
+            return False
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            self.finished = True
+            text = self.decoder.decode(b"", final=True)
+        else:
+            text = self.decoder.decode(chunk)
+        self.buffer = self.buffer[self.pos:] + text
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """
+        Skip whitespace and return the next character, or "" at the end of the input.
+        """
+        while True:
+            self.pos = JSON_WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                return ""
+
+    def expect(self, char):
+        """
+        Consume the given structural character, eg "[" or ",".
+        """
+        found = self.peek()
+        if found != char:
+            raise ValueError(f"Expected {char!r} in JSON response, found {found!r}")
+        self.pos += 1
+
+    def value(self):
+        """
+        Decode the next complete JSON value.
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = _json_decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if not self.fill():
+                    raise
+                continue
+            # A number that runs to the end of the buffer might carry on in the next chunk
+            if end == len(self.buffer) and self.fill():
+                continue
+            self.pos = end
+            return value
+
+def iter_json_items(chunks, key=None):
+    """
+    Yield the items of a JSON array as they arrive, without decoding the whole document first.
+    With a key the array is that key of a top level object, eg Torrentio's "streams", and the keys before it are skipped.
+    Without one the document itself is the array, like the Sonarr calendar.
+    """
+    reader = JsonChunkReader(chunks)
+    if key is not None:
+        reader.expect("{")
+        while True:
+            if reader.peek() == "}":
+                raise ValueError(f"No {key!r} in JSON response")
+            name = reader.value()
+            reader.expect(":")
+            if name == key:
+                break
+            reader.value()
+            if reader.peek() == ",":
+                reader.expect(",")
+    reader.expect("[")
+    if reader.peek() == "]":
+        return
+    while True:
+        yield reader.value()
+        if reader.peek() == "]":
+            return
+        reader.expect(",")
+
+def has_aired(episode):
+    """
+    Check if an episode has aired by comparing the current time
+    to the UTC air date of the episode.
+    """
+    utc_time = datetime.strptime(episode['airDateUtc'], "%Y-%m-%dT%H:%M:%SZ")
+    utc_time = utc_time.replace(tzinfo=timezone.utc)
+    return datetime.now(timezone.utc) > utc_time
+
+def see_if_imdb_exists(episode):
+    """
+    Check if the IMDb ID exists in the episode data.
+    Returns the IMDb ID or "0" if not found.
+    """
+    return episode.get("series", {}).get("imdbId", "0")
+
+def get_json(file_path='data.json'):
+    """
+    Load and return JSON data from a file.
+    If the file doesn't exist, return an empty list. Invalid data raises ValueError rather than passing for an empty watch list.
+    """
+    try:
+        with open(file_path, 'r') as file:
+            data = json.load(file)
+    except FileNotFoundError:
+        return []
+    except json.JSONDecodeError as e:
+        raise ValueError(f"{file_path} is corrupt, fix or move it out of the way: {e}") from e
+    if not isinstance(data, list):
+        raise ValueError(f"{file_path} must contain a list at the top level.")
+    return data
+
+def save_json(data, file_path='data.json'):
+    """
+    Save the given data to a JSON file. It's written and fsynced to a temporary file that then replaces the old one,
+    so a crash part way through leaves either the old file or the new one, never half of each.
+    """
+    tmp_path = file_path + ".tmp"
+    with open(tmp_path, 'w') as file:
+        json.dump(data, file, indent=4)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, file_path)
+    # The rename itself only survives a power cut once the directory is synced, which Windows can't do
+    if hasattr(os, "O_DIRECTORY"):
+        directory = os.open(os.path.dirname(os.path.abspath(file_path)), os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+def migrate_store(conn):
+    """
+    Bring the store schema up to date. Returns the version the store was at before.
+    """
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for number, script in enumerate(STORE_MIGRATIONS[version:], start=version + 1):
+        conn.executescript(script)
+        conn.execute(f"PRAGMA user_version = {number}")
+    return version
+
+def get_store(db_path=None):
+    """
+    Open the watch list store, creating and migrating it when needed.
+    A brand new store imports the existing data.json so nothing is lost on upgrade.
+    """
+    db_path = db_path or DB_PATH
+    with _store_lock:
+        if db_path not in _stores:
+            conn = sqlite3.connect(db_path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            # Every commit is synced to disk, the episode states are our journal of what was sent to RD
+            conn.execute("PRAGMA synchronous=FULL")
+            # Read before anything is created, so a corrupt data.json stops us here
+            # instead of leaving behind an empty store that would never import it
+            try:
+                watch_list = get_json() if conn.execute("PRAGMA user_version").fetchone()[0] == 0 else []
+            except ValueError:
+                conn.close()
+                raise
+            _stores[db_path] = conn
+            migrate_store(conn)
+            if watch_list:
+                print(f"Imported {store_episodes(watch_list, db_path)} episodes from data.json")
+        return _stores[db_path]
+
+def close_stores():
+    """
+    Close every open store connection.
+    """
+    with _store_lock:
+        for conn in _stores.values():
+            conn.close()
+        _stores.clear()
+        _downloaded_ids.clear()
+
+def episode_from_row(row):
+    """
+    Turn a (has_downloaded, data) row back into the episode dict we pass around.
+    """
+    episode = json.loads(row[1])
+    episode["has_downloaded"] = bool(row[0])
+    return episode
+
+def episode_instance_name(episode):
+    """
+    Name of the Sonarr instance an episode came from.
+    """
+    return episode.get("instance", DEFAULT_INSTANCE)
+
+def episode_key(episode):
+    """
+    Key that tells episodes apart across Sonarr instances, whose ids can overlap.
+    """
+    return episode_instance_name(episode), episode["id"]
+
+def episodes_by_instance(episodes):
+    """
+    Group episodes into lists of ids per Sonarr instance, for the store functions that take ids.
+    """
+    groups = {}
+    for episode in episodes:
+        groups.setdefault(episode_instance_name(episode), []).append(episode["id"])
+    return groups
+
+def find_episode(episode_id, db_path=None, instance=DEFAULT_INSTANCE):
+    """
+    Look up a single episode by its Sonarr id. Returns None if we aren't tracking it.
+    """
+    conn = get_store(db_path)
+    with _store_lock:
+        row = conn.execute("SELECT has_downloaded, data FROM episodes WHERE instance = ? AND id = ?", (instance, episode_id)).fetchone()
+    return episode_from_row(row) if row else None
+
+def load_episodes(pending_only=False, db_path=None):
+    """
+    Return the tracked episodes in the order they were added.
+    With pending_only, skip the ones we already downloaded.
+    """
+    conn = get_store(db_path)
+    query = "SELECT has_downloaded, data FROM episodes"
+    if pending_only:
+        query += " WHERE has_downloaded = 0"
+    with _store_lock:
+        rows = conn.execute(query + " ORDER BY rowid").fetchall()
+    return [episode_from_row(row) for row in rows]
+
+def store_episodes(episodes, db_path=None):
+    """
+    Add episodes to the store in one transaction. Episodes we already track are left alone.
+    Returns how many were actually added.
+    """
+    conn = get_store(db_path)
+    rows = []
+    for episode in episodes:
+        data = {key: value for key, value in episode.items() if key != "has_downloaded"}
+        downloaded = bool(episode.get("has_downloaded"))
+        rows.append((episode_instance_name(episode), episode["id"], int(downloaded), "done" if downloaded else "queued", json.dumps(data), air_timestamp(episode)))
+    with _store_lock, conn:
+        before = conn.total_changes
+        conn.executemany("INSERT OR IGNORE INTO episodes (instance, id, has_downloaded, state, data, aired_at) VALUES (?, ?, ?, ?, ?, ?)", rows)
+        # Drop the cached downloaded set rather than work out which rows were new
+        _downloaded_ids.pop(db_path or DB_PATH, None)
+        return conn.total_changes - before
+
+def mark_downloaded(episode_ids, db_path=None, instance=DEFAULT_INSTANCE):
+    """
+    Flag the given episode ids of a Sonarr instance as downloaded in one transaction.
+    """
+    conn = get_store(db_path)
+    keys = [(instance, episode_id) for episode_id in episode_ids]
+    with _store_lock, conn:
+        conn.executemany("UPDATE episodes SET has_downloaded = 1, state = 'done' WHERE instance = ? AND id = ?", keys)
+        downloaded_ids(db_path).update(keys)
+
+def mark_pending(episode_ids, db_path=None, instance=DEFAULT_INSTANCE):
+    """
+    Put the given episode ids of a Sonarr instance back on the watch list so they get searched again, starting afresh
+    in the backlog. Any hashes sent for them are forgotten too, so the same release can be sent again.
+    """
+    conn = get_store(db_path)
+    keys = [(instance, episode_id) for episode_id in episode_ids]
+    with _store_lock, conn:
+        conn.executemany(
+            "UPDATE episodes SET has_downloaded = 0, failures = 0, next_search = 0, state = 'queued', magnet = NULL, torrent_id = NULL WHERE instance = ? AND id = ?",
+            keys,
+        )
+        conn.executemany(
+            "DELETE FROM submitted_hashes WHERE info_hash IN (SELECT info_hash FROM submitted_hashes WHERE instance = ? AND episode_id = ?)", keys
+        )
+        downloaded_ids(db_path).difference_update(keys)
+
+def air_timestamp(episode):
+    """
+    When an episode aired as a unix timestamp, None if we don't know.
+    """
+    if "airDateUtc" not in episode:
+        return None
+    return datetime.strptime(episode["airDateUtc"], "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=timezone.utc).timestamp()
+
+def load_backlog(db_path=None, now=None):
+    """
+    Return the episodes still to search, most deserving first. Episodes in the slow lane come last and only once
+    they're due. The rest are ordered by how many days ago they aired plus BACKLOG_FAILURE_WEIGHT days per failed search,
+    so last night's episodes go before old ones that keep finding nothing, and ties go to the one searched longest ago.
+    Episodes part way through being sent to RD are left to resume_submissions.
+    """
+    conn = get_store(db_path)
+    now = now or time.time()
+    with _store_lock:
+        rows = conn.execute(
+            """
+            SELECT has_downloaded, data FROM episodes WHERE has_downloaded = 0 AND state = 'queued' AND next_search <= ?
+            ORDER BY failures >= ?, CAST((? - COALESCE(aired_at, 0)) / 86400 AS INTEGER) + ? * failures, COALESCE(last_searched, 0), rowid
+            """,
+            (now, BACKLOG_SLOW_AFTER, now, BACKLOG_FAILURE_WEIGHT),
+        ).fetchall()
+    return [episode_from_row(row) for row in rows]
+
+def record_search(episode, found, db_path=None):
+    """
+    Remember how an episode's search went. One that found nothing counts a failure,
+    and after BACKLOG_SLOW_AFTER of them it's only searched again after BACKLOG_SLOW_INTERVAL.
+    Episodes that aired less than BACKLOG_SLOW_INTERVAL ago never go to the slow lane, releases often take a while to show up.
+    """
+    conn = get_store(db_path)
+    now = time.time()
+    with _store_lock, conn:
+        if found:
+            conn.execute(
+                "UPDATE episodes SET failures = 0, last_searched = ?, next_search = 0 WHERE instance = ? AND id = ?",
+                (now, *episode_key(episode)),
+            )
+        else:
+            conn.execute(
+                """
+                UPDATE episodes SET failures = failures + 1, last_searched = ?,
+                    next_search = CASE WHEN failures + 1 >= ? AND COALESCE(aired_at, 0) < ? THEN ? ELSE 0 END
+                WHERE instance = ? AND id = ?
+                """,
+                (now, BACKLOG_SLOW_AFTER, now - BACKLOG_SLOW_INTERVAL, now + BACKLOG_SLOW_INTERVAL, *episode_key(episode)),
+            )
+
+def set_episode_state(episode_ids, state, db_path=None, instance=DEFAULT_INSTANCE, magnet=None, torrent_id=None):
+    """
+    Journal the step the given episode ids of a Sonarr instance got to on their way to RD, see EPISODE_STATES.
+    The magnet and torrent id are kept from earlier steps unless new ones are given. Going back to queued forgets
+    them, since the episodes are searched again from scratch.
+    """
+    if state not in EPISODE_STATES:
+        raise ValueError(f"Unknown episode state {state!r}")
+    if state == "queued":
+        query = "UPDATE episodes SET state = ?, magnet = NULL, torrent_id = NULL WHERE instance = ? AND id = ?"
+        rows = [(state, instance, episode_id) for episode_id in episode_ids]
+    else:
+        query = "UPDATE episodes SET state = ?, magnet = COALESCE(?, magnet), torrent_id = COALESCE(?, torrent_id) WHERE instance = ? AND id = ?"
+        rows = [(state, magnet, torrent_id, instance, episode_id) for episode_id in episode_ids]
+    conn = get_store(db_path)
+    with _store_lock, conn:
+        conn.executemany(query, rows)
+
+def load_unfinished_submissions(db_path=None):
+    """
+    Episodes that were part way through being sent to RD, eg when the process died, grouped by magnet.
+    Steps are only journaled once the network call before them worked, so the furthest one any episode
+    of a group got to is where the group stands. Returns a list of (state, magnet, torrent_id, episodes).
+    """
+    conn = get_store(db_path)
+    with _store_lock:
+        rows = conn.execute(
+            "SELECT state, magnet, torrent_id, has_downloaded, data FROM episodes WHERE has_downloaded = 0 AND state IN (?, ?, ?) ORDER BY rowid",
+            EPISODE_STATES[1:4],
+        ).fetchall()
+    groups = {}
+    for state, magnet, torrent_id, has_downloaded, data in rows:
+        group = groups.setdefault(magnet, {"state": state, "torrent_id": None, "episodes": []})
+        if EPISODE_STATES.index(state) > EPISODE_STATES.index(group["state"]):
+            group["state"] = state
+        group["torrent_id"] = group["torrent_id"] or torrent_id
+        group["episodes"].append(episode_from_row((has_downloaded, data)))
+    return [(group["state"], magnet, group["torrent_id"], group["episodes"]) for magnet, group in groups.items()]
+
+def downloaded_ids(db_path=None):
+    """
+    The set of downloaded (instance, episode id) keys, kept in memory so checking an episode doesn't need a query.
+    """
+    db_path = db_path or DB_PATH
+    with _store_lock:
+        if db_path not in _downloaded_ids:
+            conn = get_store(db_path)
+            _downloaded_ids[db_path] = set(conn.execute("SELECT instance, id FROM episodes WHERE has_downloaded = 1"))
+        return _downloaded_ids[db_path]
+
+def is_downloaded(episode_id, db_path=None, instance=DEFAULT_INSTANCE):
+    """
+    Whether we already downloaded the episode, including since the caller loaded it.
+    """
+    return (instance, episode_id) in downloaded_ids(db_path)
+
+def get_sync_state(key, db_path=None):
+    """
+    Read a value saved with set_sync_state, or None if it was never set.
+    """
+    conn = get_store(db_path)
+    with _store_lock:
+        row = conn.execute("SELECT value FROM sync_state WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else None
+
+def set_sync_state(key, value, db_path=None):
+    """
+    Save a value that has to survive a restart, like how far the calendar has been synced.
+    """
+    conn = get_store(db_path)
+    with _store_lock, conn:
+        conn.execute("INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)", (key, value))
+
+def calendar_fingerprint(entry):
+    """
+    The parts of a calendar entry that tell us whether it changed since we last saw it.
+    """
+    return json.dumps([entry.get(field) for field in CALENDAR_FINGERPRINT_FIELDS])
+
+def changed_calendar_entries(calendar, db_path=None, instance=DEFAULT_INSTANCE):
+    """
+    Return the calendar entries of a Sonarr instance that are new or changed since they were last marked seen.
+    """
+    conn = get_store(db_path)
+    ids = [entry["id"] for entry in calendar]
+    with _store_lock:
+        seen = dict(conn.execute(
+            f"SELECT episode_id, fingerprint FROM calendar_seen WHERE instance = ? AND episode_id IN ({','.join('?' * len(ids))})",
+            [instance, *ids],
+        ).fetchall()) if ids else {}
+    changed = [entry for entry in calendar if seen.get(entry["id"]) != calendar_fingerprint(entry)]
+    inc_counter("calendar_entries_total", len(changed), state="changed")
+    inc_counter("calendar_entries_total", len(calendar) - len(changed), state="unchanged")
+    return changed
+
+def mark_calendar_seen(entries, db_path=None, instance=DEFAULT_INSTANCE):
+    """
+    Remember the entries as they are now so the next sync can skip them if nothing changed.
+    """
+    conn = get_store(db_path)
+    rows = [(instance, entry["id"], calendar_fingerprint(entry), entry.get("airDateUtc", "")) for entry in entries]
+    with _store_lock, conn:
+        conn.executemany("INSERT OR REPLACE INTO calendar_seen (instance, episode_id, fingerprint, air_date) VALUES (?, ?, ?, ?)", rows)
+
+def forget_calendar_before(air_date, db_path=None, instance=DEFAULT_INSTANCE):
+    """
+    Drop fingerprints of entries that aired before the given time, the sync won't ask for them again.
+    """
+    conn = get_store(db_path)
+    with _store_lock, conn:
+        conn.execute("DELETE FROM calendar_seen WHERE instance = ? AND air_date < ?", (instance, f"{air_date:%Y-%m-%dT%H:%M:%SZ}"))
+
+def record_submitted_hash(info_hash, episode_ids, db_path=None, instance=DEFAULT_INSTANCE):
+    """
+    Remember that a hash was sent to RD for these episodes. Entries older than SUBMITTED_HASH_TTL are dropped.
+    """
+    conn = get_store(db_path)
+    now = time.time()
+    with _store_lock, conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO submitted_hashes (info_hash, instance, episode_id, submitted_at) VALUES (?, ?, ?, ?)",
+            [(info_hash, instance, episode_id, now) for episode_id in episode_ids],
+        )
+        conn.execute("DELETE FROM submitted_hashes WHERE submitted_at < ?", (now - SUBMITTED_HASH_TTL,))
+
+def was_submitted(info_hash, db_path=None):
+    """
+    Whether the hash was sent to RD recently, possibly before a restart.
+    """
+    conn = get_store(db_path)
+    with _store_lock:
+        row = conn.execute(
+            "SELECT 1 FROM submitted_hashes WHERE info_hash = ? AND submitted_at >= ? LIMIT 1",
+            (info_hash, time.time() - SUBMITTED_HASH_TTL),
+        ).fetchone()
+    return row is not None
+
+def torrentio_cache_key(imdb_id, season, episode):
+    """
+    Key for an episode's Torrentio answer in the cache.
+    """
+    return f"{imdb_id}:{season}:{episode}"
+
+def filter_key(quality_terms, matchers):
+    """
+    Short fingerprint of the filters candidates were picked with, since only the candidates are cached.
+    """
+    banned = matchers["banned"].pattern if matchers["banned"] else None
+    return hashlib.sha1(json.dumps([sorted(quality_terms), banned, matchers["allow_hdr"]]).encode("utf-8")).hexdigest()[:12]
+
+def get_cached_torrentio(key, db_path=None):
+    """
+    Return the cached Torrentio response for the key, or None if there isn't a fresh one.
+    """
+    conn = get_store(db_path)
+    now = time.time()
+    with _store_lock, conn:
+        row = conn.execute("SELECT body FROM torrentio_cache WHERE key = ? AND expires_at > ?", (key, now)).fetchone()
+        if row is None:
+            return None
+        conn.execute("UPDATE torrentio_cache SET last_used = ? WHERE key = ?", (now, key))
+    return row[0]
+
+def cache_torrentio_result(key, body, matched, db_path=None):
+    """
+    Cache a Torrentio response. Responses where nothing matched are kept for a shorter time
+    that doubles every time it happens again, so dead episodes stop costing a request every cycle.
+    The least recently used entries are dropped once there are more than TORRENTIO_CACHE_SIZE.
+    """
+    conn = get_store(db_path)
+    now = time.time()
+    with _store_lock, conn:
+        row = conn.execute("SELECT empty_streak FROM torrentio_cache WHERE key = ?", (key,)).fetchone()
+        if matched:
+            empty_streak, ttl = 0, TORRENTIO_CACHE_TTL
+        else:
+            empty_streak = (row[0] if row else 0) + 1
+            ttl = min(TORRENTIO_EMPTY_TTL * 2 ** (empty_streak - 1), TORRENTIO_EMPTY_MAX_TTL)
+        conn.execute(
+            "INSERT OR REPLACE INTO torrentio_cache (key, body, expires_at, empty_streak, last_used) VALUES (?, ?, ?, ?, ?)",
+            (key, body, now + ttl, empty_streak, now),
+        )
+        conn.execute(
+            "DELETE FROM torrentio_cache WHERE key IN (SELECT key FROM torrentio_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+            (TORRENTIO_CACHE_SIZE,),
+        )
+    return ttl
+
+def import_json(file_path='data.json', db_path=None):
+    """
+    Import a data.json watch list into the store. Raises ValueError if the file is corrupt.
+    """
+    added = store_episodes(get_json(file_path), db_path)
+    if added:
+        print(f"Imported {added} episodes from {file_path}")
+    return added
+
+def export_json(file_path='data.json', db_path=None):
+    """
+    Write the whole watch list out in the old data.json format.
+    """
+    save_json(load_episodes(db_path=db_path), file_path)
+
+def insert_episodes(episodes, db_path=None):
+    """
+    Insert a batch of episodes into the store, skipping the ones already present.
+    Existing ids are looked up in one query and new episodes written in one transaction.
+    """
+    conn = get_store(db_path)
+    ids = [episode["id"] for episode in episodes]
+    with _store_lock:
+        existing = {
+            (instance, episode_id): has_downloaded for instance, episode_id, has_downloaded in conn.execute(
+                f"SELECT instance, id, has_downloaded FROM episodes WHERE id IN ({','.join('?' * len(ids))})", ids
+            )
+        } if ids else {}
+
+    new_episodes = []
+    for episode in episodes:
+        key = episode_key(episode)
+        if key not in existing:
+            # Episode not found; add it
+            episode["has_downloaded"] = False
+            new_episodes.append(episode)
+            existing[key] = 0
+            print(f"{episode_label(episode)} added to search")
+        # Episode already exists; check if it's downloaded or still searching
+        elif existing[key]:
+            print(f"{episode_label(episode)} already downloaded.")
+        else:
+            print(f"{episode_label(episode)} already searching.")
+    store_episodes(new_episodes, db_path)
+
+def insert_episode(episode, db_path=None):
+    """
+    Insert episode details into the store if not already present.
+    """
+    insert_episodes([episode], db_path)
+
+def split_by_dash_and_space(s):
+    split_by_dash = s.split('-')
+    split_results = [item.split() for item in split_by_dash]
+    flattened = list(itertools.chain.from_iterable(split_results))
+    return flattened
+
+def send_torrent_io_request(url, read=None):
+    """
+    Send a GET request to Torrentio and return the response as a string,
+    or what read(res) made of it when the response is parsed as it arrives.
+    """
+    host, port, secure = TORRENTIO_SERVER
+    res, body = pooled_request(host, port, lambda conn: conn.request("GET", url, '', {}), secure=secure, endpoint="/stream/series", read=read)
+    return body if read else body.decode('utf-8')
+
+def check_torrentio(imdb_id, season, episode, read=None):
+    """
+    Check Torrentio for torrents using the IMDb ID, season, and episode.
+    """
+    url = f"/sort=size%7Cqualityfilter=other,scr,cam,unknown/stream/series/{imdb_id}:{season}:{episode}.json"
+    return send_torrent_io_request(url, read)
+
+# Torrentio puts the stats on their own line, eg "👤 12 💾 1.4 GB ⚙️ ThePirateBay"
+SEEDERS_PATTERN = re.compile(r"👤 (\d+)")
+SIZE_PATTERN = re.compile(r"💾 ([\d.]+) ([KMGT]B)")
+RESOLUTION_PATTERN = re.compile(r"\b(2160p|1080p|720p|576p|480p|4k)\b", re.IGNORECASE)
+SOURCE_PATTERN = re.compile(r"\b(remux|blu-?ray|bdrip|brrip|web-?dl|webrip|web|hdtv|dvdrip)\b", re.IGNORECASE)
+# Episode and season markers in a torrent name, eg S01E02, S01E01-E06, S01E01-06, S01, Season 1.
+# The end of a range has to be E-prefixed or come after a dash, and can't be a resolution like the 720 of S01E05-720p.
+# A season marker followed by an episode number, like S2 - 05, S01 EP05 or Season 1 Episode 5, is a single episode
+EPISODE_PATTERN = re.compile(r"\bS(\d{1,2})[ .]?E(\d{1,3})(?:(?:-E?|E)(\d{1,3})(?!\d|[pi]\b))?", re.IGNORECASE)
+SEASON_PATTERN = re.compile(
+    r"\b(?:S|Season[ .]?)(\d{1,2})\b(?![ ._]*(?:-[ ._]*|(?:Episode|Ep|E)[ ._]?)\d{1,3}(?!\d|[pi]\b))", re.IGNORECASE
+)
+# Language flags are pairs of regional indicator symbols
+FLAG_PATTERN = re.compile("[\U0001F1E6-\U0001F1FF]{2}")
+SIZE_UNITS = {"KB": 1 / (1024 * 1024), "MB": 1 / 1024, "GB": 1, "TB": 1024}
+
+# Everything we need to know about a stream, worked out once from its title
+StreamRecord = namedtuple("StreamRecord", "seeders size resolution source hdr languages banned pack lower_title stream")
+
+def compile_banned_words(banned_words):
+    """
+    Build one regex matching any of the banned words from the BANNED_WORDS json list.
+    Returns None when there is nothing to ban.
+    """
+    try:
+        banned_words = json.loads(banned_words)
+    except json.JSONDecodeError:
+        banned_words = []
+    if not banned_words:
+        return None
+    return re.compile("|".join(re.escape(word) for word in banned_words))
+
+def build_title_matchers():
+    """
+    Build the config-derived matchers used when ranking streams.
+    """
+    return {
+        "banned": compile_banned_words(os.getenv("BANNED_WORDS", "[]")),
+        "allow_hdr": os.getenv("HDR_MODE") != "false",
+    }
+
+# Built once at startup rather than for every episode
+TITLE_MATCHERS = build_title_matchers()
+
+# A Sonarr server we poll, along with the filters for its torrents
+SonarrInstance = namedtuple("SonarrInstance", "name host port api_key matchers")
+
+def load_sonarr_instances(config=None):
+    """
+    Read the Sonarr servers to poll from SONARR_INSTANCES, a JSON list like
+    [{"name": "4k", "host": "127.0.0.1", "port": 8990, "api_key": "...", "banned_words": ["/ 🇮🇹"], "hdr_mode": true}].
+    Without it there is one instance called "default", set up by API_KEY, HOST, PORT, BANNED_WORDS and HDR_MODE.
+    Returns a dict of name -> SonarrInstance. Raises ValueError saying what's wrong if the list can't be used.
+    """
+    if config is None:
+        try:
+            config = json.loads(os.getenv("SONARR_INSTANCES") or "[]")
+        except ValueError as e:
+            raise ValueError(f"SONARR_INSTANCES isn't valid JSON: {e}") from None
+    if not config:
+        api_key, host, port = set_env()
+        return {DEFAULT_INSTANCE: SonarrInstance(DEFAULT_INSTANCE, host, port, api_key, TITLE_MATCHERS)}
+    if not isinstance(config, list):
+        raise ValueError("SONARR_INSTANCES has to be a JSON list of instances")
+    instances = {}
+    for number, item in enumerate(config, 1):
+        if not isinstance(item, dict) or not item.get("name") or not item.get("api_key"):
+            raise ValueError(f"Sonarr instance {number} in SONARR_INSTANCES needs a name and an api_key")
+        name = item["name"]
+        if name in instances:
+            raise ValueError(f"Sonarr instance {name!r} is listed more than once in SONARR_INSTANCES")
+        try:
+            port = int(item.get("port", 8989))
+        except (TypeError, ValueError):
+            raise ValueError(f"Sonarr instance {name!r} in SONARR_INSTANCES has a port that isn't a number") from None
+        matchers = {
+            "banned": compile_banned_words(json.dumps(item.get("banned_words", []))),
+            "allow_hdr": str(item.get("hdr_mode", True)).lower() != "false",
+        }
+        instances[name] = SonarrInstance(name, item.get("host", "127.0.0.1"), port, item["api_key"], matchers)
+    return instances
+
+# Read from the environment the first time it's needed, see sonarr_instances
+_sonarr_instances = None
+
+def sonarr_instances():
+    """
+    The configured Sonarr instances by name, loaded by load_sonarr_instances the first time they're asked for.
+    """
+    global _sonarr_instances
+    if _sonarr_instances is None:
+        _sonarr_instances = load_sonarr_instances()
+    return _sonarr_instances
+
+def get_instance(name=None):
+    """
+    Look up a configured Sonarr instance by name, the default one if no name is given.
+    """
+    name = name or DEFAULT_INSTANCE
+    instances = sonarr_instances()
+    if name not in instances:
+        raise KeyError(f"No Sonarr instance called {name!r}, check SONARR_INSTANCES")
+    return instances[name]
+
+def sonarr_host(instance_name=None):
+    """
+    Name requests to a Sonarr instance are limited under. Each instance gets its own SONARR_CONCURRENCY.
+    """
+    return f"sonarr:{instance_name or DEFAULT_INSTANCE}"
+
+def parse_seeders(title):
+    """
+    Read the seeder count out of a Torrentio title, 0 if it isn't there.
+    """
+    match = SEEDERS_PATTERN.search(title)
+    return int(match.group(1)) if match else 0
+
+def parse_pack(name):
+    """
+    Work out whether a torrent name is a pack. Returns None for a single episode (or if we can't tell),
+    (season, None) for a whole season, or (season, (first, last)) for a range of episodes.
+    """
+    episode = EPISODE_PATTERN.search(name)
+    if episode:
+        if episode.group(3) is None:
+            return None
+        return int(episode.group(1)), (int(episode.group(2)), int(episode.group(3)))
+    season = SEASON_PATTERN.search(name)
+    if season:
+        return int(season.group(1)), None
+    return None
+
+def pack_coverage(record, season, episode_numbers):
+    """
+    Which of the given episode numbers of a season a pack stream covers.
+    """
+    if record.pack is None or record.pack[0] != season:
+        return set()
+    if record.pack[1] is None:
+        return set(episode_numbers)
+    first, last = record.pack[1]
+    return {number for number in episode_numbers if first <= number <= last}
+
+def parse_stream(stream, matchers=None):
+    """
+    Parse a Torrentio stream into a StreamRecord in a single look at its title.
+    """
+    matchers = matchers or TITLE_MATCHERS
+    title = stream["title"]
+    size = SIZE_PATTERN.search(title)
+    resolution = RESOLUTION_PATTERN.search(title) or RESOLUTION_PATTERN.search(stream.get("name", ""))
+    source = SOURCE_PATTERN.search(title)
+    return StreamRecord(
+        seeders=parse_seeders(title),
+        size=float(size.group(1)) * SIZE_UNITS[size.group(2)] if size else 0.0,
+        resolution=resolution.group(1).lower() if resolution else None,
+        source=source.group(1).lower().replace("-", "") if source else None,
+        hdr="HDR" in title,
+        languages=tuple(FLAG_PATTERN.findall(title)),
+        banned=bool(matchers["banned"] and matchers["banned"].search(title)),
+        # For packs Torrentio lists the torrent name first and the episode's file after it
+        pack=parse_pack(title.split("\n", 1)[0]),
+        lower_title=title.lower(),
+        stream=stream,
+    )
+
+def select_streams(streams, quality_terms, top_k=None, matchers=None):
+    """
+    Parse, filter and sort the streams for an episode in one pass.
+    With top_k only that many of the best are kept in a heap while the rest are dropped as they go by,
+    so streams can be fed straight from the response. Ties keep Torrentio's order.
+    Returns the StreamRecords that passed the language, HDR and quality filters, most seeders first,
+    and how many streams there were in total.
+    """
+    matchers = matchers or TITLE_MATCHERS
+    terms = [term.lower() for term in quality_terms]
+    heap = []
+    total = 0
+    for index, stream in enumerate(streams):
+        total += 1
+        record = parse_stream(stream, matchers)
+        if record.banned or (record.hdr and not matchers["allow_hdr"]):
+            continue
+        #ideally we'd search for both 1080p and WEB_DL seperately, but if we match for two out of the array it works for now
+        if not does_match_two_terms(terms, record.lower_title):
+            continue
+        entry = (record.seeders, -index, record)
+        if top_k is None or len(heap) < top_k:
+            heapq.heappush(heap, entry)
+        else:
+            heapq.heappushpop(heap, entry)
+    return [record for seeders, index, record in sorted(heap, reverse=True)], total
+
+def rank_streams(streams, quality_terms, matchers=None):
+    """
+    Parse, filter and sort every stream for an episode.
+    Returns the StreamRecords that passed the language, HDR and quality filters, most seeders first.
+    """
+    return select_streams(streams, quality_terms, matchers=matchers)[0]
+
+def compact_stream(stream):
+    """
+    The parts of a stream we need again later, which is what gets cached.
+    """
+    return {key: stream[key] for key in ("name", "title", "infoHash") if key in stream}
+
+# Higher is better, anything we couldn't read out of the title counts as 0
+RESOLUTION_RANKS = {"480p": 1, "576p": 2, "720p": 3, "1080p": 4, "2160p": 5, "4k": 5}
+SOURCE_RANKS = {"dvdrip": 1, "hdtv": 2, "bdrip": 3, "brrip": 3, "web": 4, "webrip": 4, "webdl": 5, "bluray": 6, "remux": 7}
+# A season pack's size is spread over this many episodes, we don't know how long the season really is
+SEASON_PACK_EPISODES = 10
+
+def compile_quality_preference(quality_profile):
+    """
+    Work out how much the profile wants each (source, resolution), eg ("webdl", "1080p").
+    Sonarr lists the profile items worst first, so the later an allowed item comes the higher its rank.
+    Qualities grouped in one item share its rank. (None, resolution) holds the best rank for a resolution,
+    for titles that don't say what the source is.
+    """
+    preference = {}
+    allowed = [item for item in quality_profile["items"] if get_quality_allowed(item)]
+    for rank, item in enumerate(allowed, start=1):
+        for name in get_individual_qualities(item):
+            resolution = RESOLUTION_PATTERN.search(name or "")
+            source = SOURCE_PATTERN.search(name or "")
+            if not resolution:
+                continue
+            resolution = resolution.group(1).lower()
+            source = source.group(1).lower().replace("-", "") if source else None
+            for key in ((source, resolution), (None, resolution)):
+                preference[key] = max(preference.get(key, 0), rank)
+    return preference
+
+def preference_rank(record, preference):
+    """
+    Rank of a stream's quality in the profile, 0 if the profile doesn't list it.
+    """
+    resolution = "2160p" if record.resolution == "4k" else record.resolution
+    return preference.get((record.source, resolution)) or preference.get((None, resolution), 0)
+
+def pack_episode_count(record):
+    """
+    How many episodes a stream's size is spread over.
+    """
+    if record.pack is None:
+        return 1
+    if record.pack[1] is None:
+        return SEASON_PACK_EPISODES
+    first, last = record.pack[1]
+    return max(last - first + 1, 1)
+
+def build_score_columns(batches, preference):
+    """
+    Lay the features of every candidate in the batches out as one column per feature, so they can be scored in one go.
+    Returns the columns and where each batch starts in them, with the end of the last batch on the end.
+    """
+    columns = {"seeders": [], "size": [], "resolution": [], "source": [], "preference": []}
+    offsets = [0]
+    top_rank = max(preference.values(), default=0) or 1
+    top_resolution = max(RESOLUTION_RANKS.values())
+    top_source = max(SOURCE_RANKS.values())
+    for batch in batches:
+        for record in batch:
+            columns["seeders"].append(record.seeders)
+            columns["size"].append(record.size / pack_episode_count(record))
+            columns["resolution"].append(RESOLUTION_RANKS.get(record.resolution, 0) / top_resolution)
+            columns["source"].append(SOURCE_RANKS.get(record.source, 0) / top_source)
+            columns["preference"].append(preference_rank(record, preference) / top_rank)
+        offsets.append(len(columns["seeders"]))
+    return columns, offsets
+
+def score_columns(columns, offsets, weights=None):
+    """
+    Weighted score of every row in the columns. Seeders (on a log scale) and size per episode are measured
+    against the best candidate of the same batch, the other features are already between 0 and 1.
+    Returns the scores and, for each batch, its rows from best to worst. Ties keep the order the rows came in.
+    """
+    weights = weights or STREAM_SCORE_WEIGHTS
+    scores = [0.0] * offsets[-1]
+    for start, end in zip(offsets, offsets[1:]):
+        seeders = [math.log1p(value) for value in columns["seeders"][start:end]]
+        sizes = columns["size"][start:end]
+        top_seeders = max(seeders, default=0) or 1
+        top_size = max(sizes, default=0) or 1
+        for row, (seed, size, resolution, source, preference) in enumerate(zip(
+                seeders, sizes, columns["resolution"][start:end], columns["source"][start:end], columns["preference"][start:end]), start):
+            scores[row] = (weights["seeders"] * seed / top_seeders + weights["size"] * size / top_size
+                           + weights["resolution"] * resolution + weights["source"] * source + weights["preference"] * preference)
+    orders = [sorted(range(start, end), key=scores.__getitem__, reverse=True) for start, end in zip(offsets, offsets[1:])]
+    return scores, orders
+
+def score_candidates(batches, preference, weights=None):
+    """
+    Score the candidates of several episodes together and sort each episode's candidates best first.
+    preference comes from compile_quality_preference. Returns the sorted batches in the order they were given.
+    """
+    records = [record for batch in batches for record in batch]
+    columns, offsets = build_score_columns(batches, preference)
+    scores, orders = score_columns(columns, offsets, weights)
+    return [[records[row] for row in order] for order in orders]
+
+def sort_results_by_seeders(results):
+    """
+    Sort torrent results by the number of seeders in descending order.
+    """
+    return sorted(results['streams'], key=lambda x: parse_seeders(x['title']), reverse=True)
+
+def filter_hdr(torrents):
+    """
+    Filter out torrents that contain 'HDR' in the title.
+    """
+    return [torrent for torrent in torrents if "HDR" not in torrent["title"]]
+
+def remove_different_languages(possible):
+    """
+    Remove torrents containing specific banned words.
+    """
+    banned = compile_banned_words(os.getenv("BANNED_WORDS", "[]"))
+    if banned is None:
+        return list(possible)
+    return [item for item in possible if not banned.search(item['title'])]
+
+class DebridRateLimited(Exception):
+    """
+    Real-Debrid answered 429. retry_after is how many seconds it wants us to wait, if it said.
+    """
+
+    def __init__(self, retry_after=None):
+        super().__init__(f"Real-Debrid rate limit hit, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+class DebridError(Exception):
+    """
+    Real-Debrid answered with an error, eg {"error": "infringing_file"} when it refuses a magnet.
+    """
+
+    def __init__(self, status, body):
+        super().__init__(f"Real-Debrid answered {status}: {body}")
+        self.status = status
+        self.body = body
+
+def build_form_data(name, value):
+    """RD is finnicky about its form bodies, so build the multipart body by hand. Returns the payload and content type"""
+    dataList = []
+    boundary = 'wL36Yn8afVp8Ag7AmP8qZ0SA4n1v9T'
+    dataList.append(encode('--' + boundary))
+    dataList.append(encode(f'Content-Disposition: form-data; name={name};'))
+    dataList.append(encode('Content-Type: {}'.format('text/plain')))
+    dataList.append(encode(''))
+    dataList.append(encode(value))
+    dataList.append(encode('--'+boundary+'--'))
+    dataList.append(encode(''))
+    return b'\r\n'.join(dataList), 'multipart/form-data; boundary={}'.format(boundary)
+
+def debrid_request(method, path, endpoint, payload='', content_type=None):
+    """
+    Send a request to the Real-Debrid API and return the body as a string.
+    Raises DebridRateLimited if RD says we're going too fast, and DebridError for any other answer that isn't a success.
+    """
+    rd_key = os.getenv("DEBRID_KEY")
+    headers = {
+    'Authorization': f'Bearer {rd_key}',
+    }
+    if content_type:
+        headers['Content-type'] = content_type
+    host, port, secure = DEBRID_SERVER
+    res, data = pooled_request(host, port, lambda conn: conn.request(method, "/rest/1.0" + path, payload, headers), secure=secure, endpoint=endpoint,
+                               idempotent=method in ("GET", "HEAD"))
+    if res.status == 429:
+        retry_after = res.getheader("Retry-After")
+        raise DebridRateLimited(float(retry_after) if retry_after and retry_after.isdigit() else None)
+    if not 200 <= res.status < 300:
+        raise DebridError(res.status, data.decode("utf-8", "replace"))
+    return data.decode("utf-8")
+
+def send_magnet_debrid(magnet):
+    """Adding the magnet link to the body form and getting RD to add it to library"""
+    payload, content_type = build_form_data("magnet", magnet)
+    return debrid_request("POST", "/torrents/addMagnet", "/torrents/addMagnet", payload, content_type)
+
+def start_torrent_download(torrent_id):
+    """We need to find the torrent on RD and start the download for some reason"""
+    payload, content_type = build_form_data("files", "all")
+    return debrid_request("POST", "/torrents/selectFiles/" + torrent_id, "/torrents/selectFiles", payload, content_type)
+
+def get_torrent_info(torrent_id):
+    """
+    Ask RD about the torrent with the given id: its name, status, files and so on.
     """
-    api_key = os.getenv("API_KEY")
-    host = os.getenv("HOST", "127.0.0.1")
-    port = int(os.getenv("PORT", 8989))
-    return api_key, host, port
+    return json.loads(debrid_request("GET", "/torrents/info/" + torrent_id, "/torrents/info"))
 
-def connect_http(host, port):
+def get_torrent_filename(torrent_id):
     """
-    Create and return an HTTP connection to the specified host and port.
+    Ask RD what the torrent with the given id is called, which is its folder name on the mount.
     """
-    return http.client.HTTPConnection(host, port)
+    return get_torrent_info(torrent_id)["filename"]
 
-def send_request(api_key, conn, endpoint):
+def get_instant_availability(hashes):
     """
-    Send a GET request to the specified endpoint with the given API key.
+    Ask RD which of the given infoHashes it already has cached, in one request.
+    Returns a dict of hash -> True/False.
     """
-    conn.request("GET", f"{endpoint}?apikey={api_key}", '')
+    response = json.loads(debrid_request("GET", "/torrents/instantAvailability/" + "/".join(hashes), "/torrents/instantAvailability"))
+    availability = {}
+    for info_hash in hashes:
+        entry = response.get(info_hash.lower()) if isinstance(response, dict) else None
+        availability[info_hash] = bool(isinstance(entry, dict) and entry.get("rd"))
+    return availability
 
-def get_response(conn):
+async def wait_for_debrid_slot():
     """
-    Retrieve the HTTP response from the connection and return its content.
+    Wait until we're allowed to make another RD request.
+    Requests queue up in order behind a lock and are let through at RD_REQUESTS_PER_MINUTE,
+    or held back entirely while RD has told us to back off.
     """
-    return conn.getresponse().read()
+    async with loop_lock("debrid-rate"):
+        wait = max(_debrid_rate["blocked_until"], _debrid_rate["next_slot"]) - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        _debrid_rate["next_slot"] = time.monotonic() + 60 / RD_REQUESTS_PER_MINUTE
 
-def decode_response(response):
+async def debrid_call(func, *args):
     """
-    Decode the HTTP response and return it as a string.
+    Run a Real-Debrid request function through the rate limited queue.
+    When RD answers 429 everything waits for the back off and the request is tried again instead of failing.
     """
-    return response.decode('utf-8')
+    for attempt in range(RD_MAX_RETRIES + 1):
+        await wait_for_debrid_slot()
+        try:
+            return await run_on_host("debrid", func, *args)
+        except DebridRateLimited as e:
+            if attempt == RD_MAX_RETRIES:
+                raise
+            delay = e.retry_after or 2 ** attempt
+            print(f"Real-Debrid rate limit hit, backing off for {delay}s")
+            _debrid_rate["blocked_until"] = time.monotonic() + delay
 
-def has_aired(episode):
+async def prefer_cached_streams(candidates):
     """
-    Check if an episode has aired by comparing the current time
-    to the UTC air date of the episode.
+    Check which of the top RD_AVAILABILITY_TOP_N candidates RD already has cached and move those to the front,
+    keeping their ranking otherwise. Answers are cached by hash so each hash is only asked about once in a while.
     """
-    utc_time = datetime.strptime(episode['airDateUtc'], "%Y-%m-%dT%H:%M:%SZ")
-    utc_time = pytz.UTC.localize(utc_time)
-    return datetime.now(pytz.UTC) > utc_time
+    if not RD_INSTANT_AVAILABILITY or len(candidates) < 2:
+        return candidates
+    top = candidates[:RD_AVAILABILITY_TOP_N]
+    now = time.monotonic()
+    unknown = []
+    for record in top:
+        info_hash = record.stream["infoHash"]
+        cached = _availability_cache.get(info_hash)
+        if cached and cached[0] > now:
+            inc_counter("cache_requests_total", cache="availability", result="hit")
+        else:
+            inc_counter("cache_requests_total", cache="availability", result="miss")
+            unknown.append(info_hash)
+    if unknown:
+        try:
+            availability = await debrid_call(get_instant_availability, unknown)
+        except Exception as e:
+            # Not being able to check shouldn't stop us sending the best ranked stream
+            print(f"Couldn't check Real-Debrid availability: {e!r}")
+            return candidates
+        for info_hash, is_cached in availability.items():
+            _availability_cache[info_hash] = (now + RD_AVAILABILITY_TTL, is_cached)
+    ready = [record for record in top if _availability_cache[record.stream["infoHash"]][1]]
+    waiting = [record for record in top if not _availability_cache[record.stream["infoHash"]][1]]
+    return ready + waiting + candidates[RD_AVAILABILITY_TOP_N:]
 
-def see_if_imdb_exists(episode):
+def loop_results(results):
     """
-    Check if the IMDb ID exists in the episode data.
-    Returns the IMDb ID or "0" if not found.
+    Process torrent results by sorting them based on seeders.
     """
-    return episode.get("series", {}).get("imdbId", "0")
+    return sort_results_by_seeders(results)
 
-def get_json(file_path='data.json'):
+def episode_label(episode):
     """
-    Load and return JSON data from a file.
-    If the file doesn't exist or contains invalid data, return an empty list.
+    Human readable name of an episode for log output.
     """
-    try:
-        with open(file_path, 'r') as file:
-            data = json.load(file)
-            if isinstance(data, list):
-                return data
-            raise ValueError("JSON file must contain a list at the top level.")
-    except (FileNotFoundError, ValueError):
-        return []
+    return f"{episode['series']['title']} Season {episode['seasonNumber']} Episode {episode['episodeNumber']}"
 
-def save_json(data, file_path='data.json'):
+async def single_flight(registry, key, func, *args):
     """
-    Save the given data to a JSON file.
+    Run func(*args), unless work for the same key is already in flight, in which case wait for that instead.
     """
-    with open(file_path, 'w') as file:
-        json.dump(data, file, indent=4)
+    task = registry.get(key)
+    if task is None:
+        task = asyncio.ensure_future(func(*args))
+        registry[key] = task
+        task.add_done_callback(lambda done: registry.pop(key, None))
+    else:
+        inc_counter("duplicates_skipped_total", kind="episode")
+    return await task
+
+async def process_episode(episode):
+    """
+    Find the best torrent for a single episode and send it to debrid.
+    Returns True if something was sent, so we know to update the library.
+    """
+    return await single_flight(_inflight_episodes, episode_key(episode), search_episode, episode)
+
+async def search_episode(episode):
+    """
+    Search for an episode and send the best torrent, unless it was downloaded in the meantime.
+    """
+    imdb_id = see_if_imdb_exists(episode)
+    if imdb_id == "0" or episode["has_downloaded"] == True or is_downloaded(episode["id"], instance=episode_instance_name(episode)):
+        return False
+    inc_counter("episodes_total", stage="processed")
+    print(f"Finding torrents for {episode_label(episode)}")
+    candidates, from_cache = await find_candidates(episode)
+    # An empty answer from the cache isn't a new search, so it doesn't count as another failure
+    if candidates or not from_cache:
+        record_search(episode, bool(candidates))
+    if not candidates:
+        return False
+    inc_counter("episodes_total", stage="matched")
+    candidates = await prefer_cached_streams(candidates)
+    magnet = find_magnet(candidates[0].stream)
+    print(f"Best torrent magnet for {episode_label(episode)}: {magnet}")
+    await submit_episode(episode, magnet)
+    return True
 
-def insert_episode(episode, file_path='data.json'):
+async def find_candidates(episode):
     """
-    Insert episode details into the JSON file if not already present.
+    Get the Torrentio streams for an episode, from the cache when we can, and rank them.
+    Returns the candidates and whether they came from the cache rather than Torrentio.
     """
-    data = get_json(file_path)
-    
-    # Check if the episode ID already exists in the data
-    existing = next((obj for obj in data if obj.get("id") == episode["id"]), None)
-    
-    if existing is None:
-        # Episode not found; add it
-        episode["has_downloaded"] = False
-        data.append(episode)
-        print(f"{episode['series']['title']} Season {episode['seasonNumber']} Episode {episode['episodeNumber']} added to search")
+    imdb_id = see_if_imdb_exists(episode)
+    sonarr = get_instance(episode_instance_name(episode))
+    #Need to find the quality profile, find the qualities that match that profile and then filter results
+    quality_terms = await get_profile_terms(get_quality_profile_id(episode), sonarr.name)
+    # Instances with the same filters share cached answers
+    cache_key = torrentio_cache_key(imdb_id, episode['seasonNumber'], episode['episodeNumber']) + "|" + filter_key(quality_terms, sonarr.matchers)
+    body = get_cached_torrentio(cache_key)
+    from_cache = body is not None
+    inc_counter("cache_requests_total", cache="torrentio", result="hit" if from_cache else "miss")
+    if from_cache:
+        candidates, total = select_streams(json.loads(body)["streams"], quality_terms, TORRENTIO_TOP_K, sonarr.matchers)
     else:
-        # Episode already exists; check if it's downloaded or still searching
-        if existing["has_downloaded"]:
-            print(f"{episode['series']['title']} Season {episode['seasonNumber']} Episode {episode['episodeNumber']} already downloaded.")
-        else:
-            print(f"{episode['series']['title']} Season {episode['seasonNumber']} Episode {episode['episodeNumber']} already searching.")
-    
-    # Save the updated data back to the file
-    time.sleep(5)
-    save_json(data, file_path)
+        # Parsed and filtered as the response arrives, so a huge answer never sits in memory whole
+        read = lambda res: select_streams(iter_json_items(read_chunks(res), "streams"), quality_terms, TORRENTIO_TOP_K, sonarr.matchers)
+        candidates, total = await run_on_host("torrentio", check_torrentio, imdb_id, episode['seasonNumber'], episode['episodeNumber'], read)
+        # Only the candidates we kept are cached, not the whole answer
+        cache_torrentio_result(cache_key, json.dumps({"streams": [compact_stream(record.stream) for record in candidates]}), bool(candidates))
+    print(f"Found {total} possible torrents for {episode_label(episode)}{' (cached)' if from_cache else ''}, kept {len(candidates)}")
+    # The most seeded candidates were kept, now put the ones the profile likes best first
+    return score_candidates([candidates], get_profile_preference(get_quality_profile_id(episode), sonarr.name))[0], from_cache
 
-def split_by_dash_and_space(s):
-    split_by_dash = s.split('-')
-    split_results = [item.split() for item in split_by_dash]
-    flattened = list(itertools.chain.from_iterable(split_results))
-    return flattened
+def group_by_season(data):
+    """
+    Group the episodes still to download by series and season.
+    """
+    groups = {}
+    for episode in data:
+        imdb_id = see_if_imdb_exists(episode)
+        if imdb_id != "0" and not episode["has_downloaded"]:
+            groups.setdefault((episode_instance_name(episode), imdb_id, episode["seasonNumber"]), []).append(episode)
+    return list(groups.values())
 
-def send_torrent_io_request(url):
+async def try_season_pack(episodes):
     """
-    Send a GET request to Torrentio and return the response as a string.
+    Look for a season pack covering enough of the given episodes of one season and send it.
+    Returns the keys of the episodes the pack covered, empty if we didn't find one.
     """
-    conn = http.client.HTTPSConnection("torrentio.strem.fun")
-    conn.request("GET", url, '', {})
-    res = conn.getresponse()
-    return res.read().decode('utf-8')
+    first = min(episodes, key=lambda episode: episode["episodeNumber"])
+    season = first["seasonNumber"]
+    missing = {episode["episodeNumber"] for episode in episodes}
+    print(f"Looking for a season pack for {first['series']['title']} Season {season}, {len(missing)} episodes missing")
+    coverage = {}
+    candidates, from_cache = await find_candidates(first)
+    # The search for the first episode on its own gets this answer from the cache, so it's counted here
+    if not from_cache:
+        record_search(first, bool(candidates))
+    for record in candidates:
+        covered = pack_coverage(record, season, missing)
+        if len(covered) >= len(missing) * SEASON_PACK_MIN_COVERAGE:
+            coverage[record.stream["infoHash"]] = (record, covered)
+    if not coverage:
+        return set()
+    best = (await prefer_cached_streams([record for record, covered in coverage.values()]))[0]
+    covered = coverage[best.stream["infoHash"]][1]
+    pack_episodes = [episode for episode in episodes if episode["episodeNumber"] in covered]
+    inc_counter("episodes_total", len(pack_episodes), stage="processed")
+    inc_counter("episodes_total", len(pack_episodes), stage="matched")
+    magnet = find_magnet(best.stream)
+    print(f"Season pack for {first['series']['title']} Season {season} covers {len(pack_episodes)} episodes: {magnet}")
+    await submit_episodes(pack_episodes, magnet)
+    return {episode_key(episode) for episode in pack_episodes}
 
-def check_torrentio(imdb_id, season, episode):
+async def send_season_packs(data, budget=None):
     """
-    Check Torrentio for torrents using the IMDb ID, season, and episode.
+    Send season packs for seasons with enough episodes missing, looking at no more seasons than the budget allows.
+    Returns the episodes that still need searching one at a time, and whether any pack was sent.
     """
-    url = f"/sort=size%7Cqualityfilter=other,scr,cam,unknown/stream/series/{imdb_id}:{season}:{episode}.json"
-    return send_torrent_io_request(url)
+    groups = [group for group in group_by_season(data) if len(group) >= SEASON_PACK_MIN_EPISODES][:budget]
+    results = await asyncio.gather(*(try_season_pack(group) for group in groups), return_exceptions=True)
+    covered = set()
+    for result in results:
+        if isinstance(result, Exception):
+            print(f"Season pack search failed: {result!r}")
+        else:
+            covered |= result
+    return [episode for episode in data if episode_key(episode) not in covered], bool(covered)
 
-def sort_results_by_seeders(results):
+def journal_episodes(episodes, state, magnet=None, torrent_id=None):
     """
-    Sort torrent results by the number of seeders in descending order.
+    Journal the step episodes got to on their way to RD, one store update per Sonarr instance.
     """
-    return sorted(results['streams'], key=lambda x: int(x['title'].split('👤 ')[1].split(' ')[0]), reverse=True)
+    for instance, episode_ids in episodes_by_instance(episodes).items():
+        set_episode_state(episode_ids, state, instance=instance, magnet=magnet, torrent_id=torrent_id)
 
-def filter_hdr(torrents):
+def file_episodes(files):
     """
-    Filter out torrents that contain 'HDR' in the title.
+    The (season, episode) pairs the names of a torrent's files on RD say they are.
     """
-    return [torrent for torrent in torrents if "HDR" not in torrent["title"]]
+    found = set()
+    for file in files:
+        match = EPISODE_PATTERN.search(file.get("path", ""))
+        if match:
+            first = int(match.group(2))
+            last = int(match.group(3)) if match.group(3) else first
+            found.update((int(match.group(1)), number) for number in range(first, last + 1))
+    return found
 
-def remove_different_languages(possible):
+async def check_pack_files(episodes, torrent_id):
     """
-    Remove torrents containing specific banned words.
+    Check the file list RD has for a pack against the episodes it was sent for. The ones it has no file for
+    go back to the backlog instead of being taken off the watch list. If RD can't say, hasn't listed the files yet,
+    or their names don't say which episodes they are, the pack is taken at its word.
+    Returns the episodes the pack has.
     """
-    banned_words = os.getenv("BANNED_WORDS", "[]")
     try:
-        banned_words = json.loads(banned_words)
-    except json.JSONDecodeError:
-        banned_words = []
-    return [item for item in possible if not any(banned_word in item['title'] for banned_word in banned_words)]
+        info = await debrid_call(get_torrent_info, torrent_id)
+    except Exception as e:
+        print(f"Couldn't get the file list from Real-Debrid: {e!r}")
+        return episodes
+    found = file_episodes(info.get("files") or [])
+    if not found:
+        return episodes
+    present = [episode for episode in episodes if (episode["seasonNumber"], episode["episodeNumber"]) in found]
+    missing = [episode for episode in episodes if (episode["seasonNumber"], episode["episodeNumber"]) not in found]
+    for episode in missing:
+        print(f"{episode_label(episode)} isn't in the pack, putting it back on the backlog")
+    journal_episodes(missing, "queued")
+    return present
 
-        
-def send_magnet_debrid(magnet):
-    """This is a mess, but adding the magnet link to the body form and getting RD to add it to library"""
-    rd_key = os.getenv("DEBRID_KEY")
-    conn = http.client.HTTPSConnection("api.real-debrid.com")
-    dataList = []
-    boundary = 'wL36Yn8afVp8Ag7AmP8qZ0SA4n1v9T'
-    dataList.append(encode('--' + boundary))
-    dataList.append(encode('Content-Disposition: form-data; name=magnet;'))
-    dataList.append(encode('Content-Type: {}'.format('text/plain')))
-    dataList.append(encode(''))
-    dataList.append(encode(magnet))
-    dataList.append(encode('--'+boundary+'--'))
-    dataList.append(encode(''))
-    body = b'\r\n'.join(dataList)
-    payload = body
-    headers = {
-    'Authorization': f'Bearer {rd_key}',
-    'Content-type': 'multipart/form-data; boundary={}'.format(boundary)
-    }
-    conn.request("POST", "/rest/1.0/torrents/addMagnet", payload, headers)
-    res = conn.getresponse()
-    data = res.read()
-    return data.decode("utf-8")
+async def send_to_debrid(episodes, magnet, state="searching", torrent_id=None):
+    """
+    Add the magnet to debrid, start the download and take the episodes it covers off the watch list.
+    Each step is journaled before the next one starts, so a submission cut short by a crash carries on
+    from where it got to (state and torrent_id) instead of adding the torrent to RD again.
+    """
+    if state == "searching":
+        journal_episodes(episodes, "searching", magnet=magnet)
+        try:
+            torrent_id = json.loads(await debrid_call(send_magnet_debrid, magnet))["id"]
+        except Exception:
+            # RD didn't take it, so the episodes go back to being searched
+            journal_episodes(episodes, "queued")
+            raise
+        print("Sent magnet to debrid")
+        journal_episodes(episodes, "submitted", torrent_id=torrent_id)
+        state = "submitted"
+    if state == "submitted":
+        # If this fails the torrent is on RD already, the next backlog search starts the download from here
+        try:
+            await debrid_call(start_torrent_download, torrent_id)
+        except DebridError as e:
+            if 400 <= e.status < 500:
+                # RD won't ever start it, eg the torrent was deleted, so the episodes are searched again instead
+                journal_episodes(episodes, "queued")
+            raise
+        journal_episodes(episodes, "files_selected")
+    if len(episodes) > 1:
+        episodes = await check_pack_files(episodes, torrent_id)
+        if not episodes:
+            return
+    inc_counter("episodes_total", len(episodes), stage="sent")
+    remember_submitted(magnet_hash(magnet), episodes)
+    for episode in episodes:
+        print(f"Removing {episode_label(episode)} from watch list")
+    remove_episodes(episodes)
+    filename = None
+    if RD_MOUNT_PATH and library_backends():
+        try:
+            filename = await debrid_call(get_torrent_filename, torrent_id)
+        except Exception as e:
+            # The refresh still goes out, it just can't wait for the mount
+            print(f"Couldn't get the torrent name from Real-Debrid: {e!r}")
+    queue_library_refresh(episodes, filename)
 
-def start_torrent_download(response):
-    torrent_id = json.loads(response)["id"]
-    """We need to find the torrent on RD and start the download for some reason"""
-    #yes this is copied from above, but it's the easiest way for now because it's so damn finnicky
-    rd_key = os.getenv("DEBRID_KEY")
-    conn = http.client.HTTPSConnection("api.real-debrid.com")
-    dataList = []
-    boundary = 'wL36Yn8afVp8Ag7AmP8qZ0SA4n1v9T'
-    dataList.append(encode('--' + boundary))
-    dataList.append(encode('Content-Disposition: form-data; name=files;'))
-    dataList.append(encode('Content-Type: {}'.format('text/plain')))
-    dataList.append(encode(''))
-    dataList.append(encode("all"))
-    dataList.append(encode('--'+boundary+'--'))
-    dataList.append(encode(''))
-    body = b'\r\n'.join(dataList)
-    payload = body
-    headers = {
-    'Authorization': f'Bearer {rd_key}',
-    'Content-type': 'multipart/form-data; boundary={}'.format(boundary)
-    }
-    conn.request("POST", "/rest/1.0/torrents/selectFiles/" + torrent_id, payload, headers)
-    res = conn.getresponse()
-    data = res.read()
-    return data.decode("utf-8")
+async def submit_episode(episode, magnet):
+    """
+    Send a single episode to debrid.
+    """
+    await submit_episodes([episode], magnet)
 
-def loop_results(results):
+async def submit_episodes(episodes, magnet, state="searching", torrent_id=None):
     """
-    Process torrent results by sorting them based on seeders.
+    Send episodes to debrid in a task that keeps going if the cycle is cancelled,
+    so shutdown can wait for it instead of leaving a half added torrent behind.
+    If the same hash is already being sent, or was sent recently, the episodes share that torrent instead.
+    state and torrent_id are where an unfinished submission picks up from, see send_to_debrid.
     """
-    return sort_results_by_seeders(results)
+    if DRY_RUN:
+        print(f"Dry run, not sending {magnet} for {len(episodes)} episodes")
+        return
+    info_hash = magnet_hash(magnet)
+    task = _inflight_hashes.get(info_hash)
+    if task is not None or was_submitted(info_hash):
+        inc_counter("duplicates_skipped_total", kind="hash")
+        print(f"{info_hash} was already sent to debrid, not sending it again")
+        if task is not None:
+            await asyncio.shield(task)
+        remember_submitted(info_hash, episodes)
+        remove_episodes(episodes)
+        return
+    task = asyncio.ensure_future(send_to_debrid(episodes, magnet, state, torrent_id))
+    _inflight_submissions.add(task)
+    _inflight_hashes[info_hash] = task
+    task.add_done_callback(_inflight_submissions.discard)
+    task.add_done_callback(lambda done: _inflight_hashes.pop(info_hash, None))
+    await asyncio.shield(task)
 
-def loop_episodes(data):
+async def resume_submissions():
     """
-    Process each episode in the given data, find torrents, and display magnet links.
+    Finish sending the torrents a crash or an RD error cut short, from the last step that was journaled.
     """
-    should_update_library = False
+    for state, magnet, torrent_id, episodes in load_unfinished_submissions():
+        if magnet_hash(magnet) in _inflight_hashes:
+            continue
+        print(f"Resuming {magnet} for {len(episodes)} episodes, it got as far as {state}")
+        try:
+            await submit_episodes(episodes, magnet, state, torrent_id)
+        except Exception as e:
+            print(f"Couldn't resume {magnet}: {e!r}")
+
+async def drain_submissions(timeout=None):
+    """
+    Wait for the debrid submissions still in flight. Returns how many didn't finish in time.
+    """
+    if not _inflight_submissions:
+        return 0
+    print(f"Waiting for {len(_inflight_submissions)} debrid submissions to finish")
+    done, pending = await asyncio.wait(set(_inflight_submissions), timeout=SHUTDOWN_TIMEOUT if timeout is None else timeout)
+    return len(pending)
+
+def torrentio_requests():
+    """
+    How many Torrentio requests have been made since startup, cache misses being the ones that go out.
+    """
+    return get_metric("cache_requests_total", cache="torrentio", result="miss")
+
+async def episode_worker(queue, within_budget=None):
+    """
+    Pull episodes off the queue until it is empty, or until within_budget() says the cycle has used up its requests.
+    Returns True if any of the episodes it handled were sent to debrid.
+    """
+    sent_any = False
+    while True:
+        if within_budget and not within_budget():
+            return sent_any
+        try:
+            episode = queue.get_nowait()
+        except asyncio.QueueEmpty:
+            return sent_any
+        set_gauge("queue_depth", queue.qsize(), queue="episodes")
+        try:
+            sent_any = await process_episode(episode) or sent_any
+        except Exception:
+            # One broken episode shouldn't stop the rest of the backlog
+            traceback.print_exc()
+        finally:
+            queue.task_done()
+
+async def loop_episodes(data, budget=None):
+    """
+    Process the episodes in the given data with a pool of workers, find torrents and send them to debrid.
+    Seasons with several episodes missing try a season pack first.
+    Requests to each service are limited by HOST_LIMITS so different episodes overlap without flooding anyone.
+    With a budget no new episodes are started once that many Torrentio requests were made, the rest wait for the next cycle.
+    """
+    started_at = torrentio_requests()
+    within_budget = (lambda: torrentio_requests() - started_at < budget) if budget else None
+    data, sent_pack = await send_season_packs(data, budget)
+    queue = asyncio.Queue()
     for episode in data:
-        imdb_id = see_if_imdb_exists(episode)
-        if imdb_id != "0":
-            if episode["has_downloaded"] == True:
-                continue
-            print(f"Finding torrents for {episode['series']['title']} Season {episode['seasonNumber']} Episode {episode['episodeNumber']}")
-            results = json.loads(check_torrentio(imdb_id, episode['seasonNumber'], episode['episodeNumber']))
-            print(f"Found {len(results['streams'])} possible torrents")
-            sorted_results = loop_results(results)
-            filtered_results = remove_different_languages(sorted_results)
-            #Need to find the quality profile, find the qualities that match that profile and then filter results
-            filtered_results = handle_quality_filtering(episode,filtered_results) #now we have the words that we need to match
-            #ideally we'd search for both 1080p and WEB_DL seperately, but if we match for two out of the array it works for now
-
-            if os.getenv("HDR_MODE") == "false":
-                print("Removing HDR entries as HDR_MODE is disabled in the environment.")
-                filtered_results = filter_hdr(filtered_results)
-            if filtered_results:
-                magnet = find_magnet(filtered_results[0])
-                #print(filtered_results[0])
-                print(f"Best torrent magnet: {magnet}")
-                rd_response = send_magnet_debrid(magnet)
-                print("Sent magnet to debrid")
-                start_torrent_download(rd_response)
-                print("Removing episode from watch list")
-                time.sleep(3)
-                remove_episode(episode)
-                should_update_library = True
-    if should_update_library:
-        update_library() # we only update plex/jellyfin if an episode was downloaded
-
-
-def handle_quality_filtering(episode,results):
-    """Getting the right qualities takes some work. Logic handled here just to save the loop function"""
-    #First we need to get the quality profile id from the episode.
-    quality_profile_id = get_quality_profile_id(episode)
-    #Now we have that, we need to get the profile associated with that id
-    quality_profile = get_quality_profile(quality_profile_id)
+        queue.put_nowait(episode)
+    workers = [asyncio.create_task(episode_worker(queue, within_budget)) for _ in range(min(MAX_WORKERS, queue.qsize()))]
+    results = await asyncio.gather(*workers)
+    if not queue.empty():
+        print(f"Request budget of {budget} used up, {queue.qsize()} episodes left for the next cycle")
+        set_gauge("queue_depth", queue.qsize(), queue="episodes")
+    # Media servers are refreshed by the library refresher once what was sent shows up on the mount
+    return sent_pack or any(results)
+
+
+def compile_quality_terms(quality_profile):
+    """Turn a quality profile into the list of individual terms we match torrents against"""
     #This gives us all possible qualities with allowed or not allowed. We need to break that down into the actual words we can search for
     quality_terms = get_quality_terms(quality_profile)
     #Big list of arrays of words, eg 1080p-webdl etc. We need to split those into individual search terms.
-    split_terms = split_quality_terms(quality_terms)
-    #now we have an array of all the individual terms we can use to search and match
-    results = match_quality_torrents(split_terms,results)
-    return results
-
-def match_quality_torrents(terms,results):
-    """Take the terms we are using to search for quality and resolution, and then match that to torrents"""
-    filtered_torrents = []
-    for result in results:
-        if does_match_two_terms(terms,result["title"]):
-            filtered_torrents.append(result)
-    return filtered_torrents
-    
-def does_match_two_terms(terms,result):
-    """Finds if the torrent name contains more than two terms"""
-    matches = [term for term in terms if term.lower() in result.lower()]
-    return len(matches) >= 2
+    return split_quality_terms(quality_terms)
+
+async def get_profile_terms(quality_profile_id, instance=None):
+    """
+    Return the compiled terms for a quality profile of a Sonarr instance, only going to Sonarr when the cached copy has expired.
+    An expired entry is revalidated with its ETag so an unchanged profile isn't rebuilt.
+    """
+    key = (instance or DEFAULT_INSTANCE, quality_profile_id)
+    async with loop_lock(("qualityprofile", key)):
+        entry = _profile_cache.get(key)
+        if entry and entry["expires"] > time.monotonic():
+            inc_counter("cache_requests_total", cache="qualityprofile", result="hit")
+            return entry["terms"]
+        inc_counter("cache_requests_total", cache="qualityprofile", result="miss")
+        etag = entry["etag"] if entry else None
+        quality_profile, etag = await run_on_host(sonarr_host(instance), fetch_quality_profile, quality_profile_id, etag, instance)
+        if quality_profile is None:
+            # Sonarr says nothing changed, keep the terms we have
+            entry["expires"] = time.monotonic() + PROFILE_CACHE_TTL
+            return entry["terms"]
+        entry = {
+            "terms": compile_quality_terms(quality_profile),
+            "preference": compile_quality_preference(quality_profile),
+            "etag": etag,
+            "expires": time.monotonic() + PROFILE_CACHE_TTL,
+        }
+        _profile_cache[key] = entry
+        return entry["terms"]
+
+def get_profile_preference(quality_profile_id, instance=None):
+    """
+    The compile_quality_preference of a profile get_profile_terms has cached, empty if it hasn't.
+    """
+    entry = _profile_cache.get((instance or DEFAULT_INSTANCE, quality_profile_id))
+    return entry["preference"] if entry else {}
+
+def refresh_profile_cache(quality_profile_id=None, instance=None):
+    """
+    Forget a cached quality profile, or all of them, so the next lookup goes back to Sonarr.
+    """
+    if quality_profile_id is None:
+        _profile_cache.clear()
+    else:
+        _profile_cache.pop((instance or DEFAULT_INSTANCE, quality_profile_id), None)
+
+def does_match_two_terms(terms,lower_title):
+    """Finds if the torrent name contains at least two terms. Both need to be lowercase already"""
+    return sum(term in lower_title for term in terms) >= 2
 
 def get_quality_profile_id(episode):
     """Find the quality profile id set in sonarr"""
@@ -284,10 +2043,17 @@ def get_quality_profile_id(episode):
 
 def get_quality_profile(id):
     """Loop through the quality profile and find all matching qualities. It can be many."""
-    api_key,host,port = set_env()
-    conn = connect_http(host,port)
-    send_request(api_key,conn,f"/api/v3/qualityprofile/{id}")
-    return json.loads(decode_response(get_response(conn)))
+    return fetch_quality_profile(id)[0]
+
+def fetch_quality_profile(id, etag=None, instance=None):
+    """
+    Get a quality profile from Sonarr along with its ETag.
+    If the ETag we send still matches, Sonarr answers 304 and the profile comes back as None.
+    """
+    res, body = sonarr_get(f"/api/v3/qualityprofile/{id}", {"If-None-Match": etag} if etag else None, instance=instance)
+    if res.status == 304:
+        return None, etag
+    return json.loads(decode_response(body)), res.getheader("ETag")
 
 def get_quality_terms(quality_profile):
     quality_terms = []
@@ -326,13 +2092,25 @@ def split_quality_terms(terms):
 
 def remove_episode(episode):
     """
-    Removing from search. Not from the json, because we need to know we already downloaded it 
+    Removing from search. Not from the store, because we need to know we already downloaded it
+    """
+    remove_episodes([episode])
+
+def remember_submitted(info_hash, episodes):
+    """
+    Record that a hash was sent to RD for these episodes, whichever Sonarr instances they came from.
+    """
+    for instance, episode_ids in episodes_by_instance(episodes).items():
+        record_submitted_hash(info_hash, episode_ids, instance=instance)
+
+def remove_episodes(episodes):
+    """
+    Remove several episodes from search, one store update per Sonarr instance.
     """
-    data = get_json()
-    for item in data:
-        if item == episode:
-            item["has_downloaded"] = True
-    save_json(data)
+    for instance, episode_ids in episodes_by_instance(episodes).items():
+        mark_downloaded(episode_ids, instance=instance)
+    for episode in episodes:
+        episode["has_downloaded"] = True
 
 def find_magnet(torrent):
     """
@@ -340,95 +2118,592 @@ def find_magnet(torrent):
     """
     return "magnet:?xt=urn:btih:" + torrent['infoHash']
 
-def check_for_torrents():
+def magnet_hash(magnet):
     """
-    Check for torrents of episodes in the JSON file.
+    Get the infoHash back out of a magnet link made by find_magnet.
     """
-    data = get_json()
-    loop_episodes(data)
+    return magnet.rsplit(":", 1)[1].lower()
+
+async def check_for_torrents():
+    """
+    Check for torrents of episodes still waiting in the store, in priority order and within the request budget.
+    Torrents that didn't finish being sent last time are finished first.
+    Episodes of Sonarr instances that are no longer configured, eg ones tracked as "default" before SONARR_INSTANCES
+    was set, stay in the store but aren't searched.
+    """
+    await resume_submissions()
+    data = load_backlog()
+    instances = sonarr_instances()
+    orphaned = [episode for episode in data if episode_instance_name(episode) not in instances]
+    if orphaned:
+        names = sorted({episode_instance_name(episode) for episode in orphaned})
+        print(f"Skipping {len(orphaned)} episodes of Sonarr instances that aren't configured: {', '.join(names)}")
+        data = [episode for episode in data if episode_instance_name(episode) in instances]
+    print(f"{len(data)} episodes due in the backlog")
+    await loop_episodes(data, BACKLOG_REQUEST_BUDGET or None)
 
 def get_episode_details(show):
     """
     Retrieve detailed episode information using the API.
     """
-    api_key, host, port = set_env()
-    conn = connect_http(host, port)
-    send_request(api_key, conn, f"/api/v3/episode/{show['id']}")
-    return json.loads(decode_response(get_response(conn)))
+    res, body = sonarr_get(f"/api/v3/episode/{show['id']}", instance=show.get("instance"))
+    return json.loads(decode_response(body))
+
+def is_complete_calendar_entry(show):
+    """
+    Check whether a calendar entry already has everything we need, so we don't have to fetch the episode again.
+    """
+    series = show.get("series")
+    return (
+        all(field in show for field in CALENDAR_REQUIRED_FIELDS)
+        and isinstance(series, dict)
+        and all(field in series for field in CALENDAR_REQUIRED_SERIES_FIELDS)
+    )
+
+async def complete_calendar_entry(show):
+    """
+    Return the episode for a calendar entry, only asking Sonarr for it when the entry is missing fields.
+    """
+    if is_complete_calendar_entry(show):
+        return show
+    return await run_on_host(sonarr_host(show.get("instance")), get_episode_details, show)
 
-def loop_through_calendar(calendar):
+async def loop_through_calendar(calendar, instance=None):
     """
     Process each show in the calendar, checking if episodes have aired.
+    Aired episodes are written to the store in one batch at the end, tagged with the Sonarr instance they came from.
     """
-    for show in json.loads(calendar):
+    episodes = await asyncio.gather(*(complete_calendar_entry(show) for show in calendar), return_exceptions=True)
+    aired = []
+    for episode in episodes:
+        if isinstance(episode, Exception):
+            print(f"Couldn't get episode details: {episode!r}")
+            continue
+        if instance is not None:
+            episode["instance"] = instance
         try:
-            episode = get_episode_details(show)
-            print(f"Found {episode['series']['title']} Season {episode['seasonNumber']} Episode {episode['episodeNumber']} Released: {episode['airDateUtc']}")
+            print(f"Found {episode_label(episode)} Released: {episode['airDateUtc']}")
             if has_aired(episode):
-                insert_episode(episode)
+                aired.append(episode)
             else:
-                print(f"{episode['series']['title']} Season {episode['seasonNumber']} Episode {episode['episodeNumber']} has not aired. Ignoring.")
+                print(f"{episode_label(episode)} has not aired. Ignoring.")
         except KeyError as e:
             print(f"Missing key in show data: {e}")
+    insert_episodes(aired)
+    return aired
 
-def update_library():
-    print("Updating Jellyfin Library")
+def library_backends():
+    """
+    The media servers we refresh, as a list of functions taking the paths to scan.
+    """
+    backends = []
     if os.getenv("JELLYFIN") == "true":
-        update_jellyfin_library()
-def update_jellyfin_library():
-    """connect to jellyfin and update the library"""
+        backends.append(update_jellyfin_library)
+    if os.getenv("PLEX") == "true":
+        backends.append(update_plex_library)
+    return backends
+
+def update_library(paths=None):
+    """
+    Tell every configured media server about new files.
+    With paths only those folders are scanned, otherwise the whole library is refreshed.
+    """
+    for backend in library_backends():
+        try:
+            backend(paths)
+        except (OSError, http.client.HTTPException) as e:
+            # One media server being down shouldn't stop the other hearing about it
+            print(f"Library refresh failed: {e!r}")
+
+def update_jellyfin_library(paths=None):
+    """connect to jellyfin and update the library, or just the given folders"""
     host,port,api_key = (os.getenv(key) for key in ["JELLYFIN_HOST","JELLYFIN_PORT","JELLYFIN_API_TOKEN"])
-    conn = http.client.HTTPConnection(host, int(port))
-    payload = ''
     headers = {
     'Authorization': api_key
     }
-    conn.request("POST", "/Library/Refresh", payload, headers)
-    res = conn.getresponse()
-    data = res.read()
-async def get_calendar():
+    if paths is None:
+        print("Updating Jellyfin Library")
+        pooled_request(host, int(port), lambda conn: conn.request("POST", "/Library/Refresh", '', headers), endpoint="/Library/Refresh", idempotent=False)
+        return
+    print(f"Updating Jellyfin Library for {len(paths)} folders")
+    payload = json.dumps({"Updates": [{"Path": path, "UpdateType": "Created"} for path in paths]})
+    headers['Content-Type'] = 'application/json'
+    pooled_request(host, int(port), lambda conn: conn.request("POST", "/Library/Media/Updated", payload, headers), endpoint="/Library/Media/Updated", idempotent=False)
+
+def update_plex_library(paths=None):
+    """connect to plex and scan the library section, or just the given folders in it"""
+    host, port, token, section = (os.getenv(key) for key in ["PLEX_HOST", "PLEX_PORT", "PLEX_TOKEN", "PLEX_SECTION_ID"])
+    headers = {
+    'X-Plex-Token': token
+    }
+    urls = [f"/library/sections/{section}/refresh"]
+    if paths is not None:
+        urls = [f"/library/sections/{section}/refresh?path={quote(path)}" for path in paths]
+    print(f"Updating Plex Library{f' for {len(paths)} folders' if paths is not None else ''}")
+    for url in urls:
+        pooled_request(host, int(port or 32400), lambda conn, url=url: conn.request("GET", url, '', headers), endpoint="/library/sections/refresh")
+
+def queue_library_refresh(episodes, filename=None):
+    """
+    Queue a media server refresh for the series folders of the given episodes, once filename is on the mount.
+    Another torrent for the same series pushes its refresh back, so a busy series is only scanned once.
+    """
+    if not library_backends():
+        return
+    now = time.monotonic()
+    for path in {episode.get("series", {}).get("path") for episode in episodes}:
+        entry = _pending_refreshes.setdefault(path, {"deadline": now + LIBRARY_MOUNT_TIMEOUT, "files": set()})
+        entry["quiet_at"] = now + LIBRARY_REFRESH_DEBOUNCE
+        if filename:
+            entry["files"].add(filename)
+    set_gauge("queue_depth", len(_pending_refreshes), queue="library")
+
+def on_mount(filename):
+    """
+    Whether RD's folder for a torrent shows up on the mount yet.
+    """
+    return os.path.exists(os.path.join(RD_MOUNT_PATH, filename))
+
+async def refresh_ready_libraries(debounce=True, wait_for_mount=True):
+    """
+    Send one coalesced refresh for every queued folder whose files are on the mount and that has been quiet long enough.
+    debounce and wait_for_mount can be turned off to send folders before then. Returns how many folders were refreshed.
+    """
+    now = time.monotonic()
+    ready = []
+    for path, entry in list(_pending_refreshes.items()):
+        if debounce and entry["quiet_at"] > now:
+            continue
+        if wait_for_mount and RD_MOUNT_PATH and entry["deadline"] > now:
+            mounted = await asyncio.gather(*(asyncio.to_thread(on_mount, filename) for filename in entry["files"]))
+            if not all(mounted):
+                continue
+        ready.append(path)
+    for path in ready:
+        del _pending_refreshes[path]
+    set_gauge("queue_depth", len(_pending_refreshes), queue="library")
+    if ready:
+        # A folder we don't know the path of needs the whole library refreshed, which covers the rest too
+        await run_on_host("library", update_library, None if None in ready else ready)
+    return len(ready)
+
+async def library_refresher(stop):
+    """
+    Send queued media server refreshes as they become ready until we're told to stop.
+    """
+    while not stop.is_set():
+        try:
+            await refresh_ready_libraries()
+        except Exception:
+            traceback.print_exc()
+        try:
+            await asyncio.wait_for(stop.wait(), LIBRARY_CHECK_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+def fetch_calendar(start, end, instance=None):
+    """
+    Retrieve the calendar entries between start and end from a Sonarr instance, with the series inlined.
+    """
+    endpoint = f"/api/v3/calendar?start={start:%Y-%m-%dT%H:%M:%SZ}&end={end:%Y-%m-%dT%H:%M:%SZ}&includeSeries=true"
+    res, calendar = sonarr_get(endpoint, read=lambda res: list(iter_json_items(read_chunks(res))), instance=instance)
+    return calendar
+
+def calendar_windows(start, end, days=None):
+    """
+    Split the range between start and end into windows of at most the given number of days.
+    """
+    step = timedelta(days=days or CALENDAR_WINDOW_DAYS)
+    windows = []
+    while start < end:
+        windows.append((start, min(start + step, end)))
+        start += step
+    return windows
+
+def calendar_sync_start(now, db_path=None, instance=DEFAULT_INSTANCE):
     """
-    Retrieve the calendar data from the API.
+    Where the next calendar sync of a Sonarr instance should start: a little before the last one finished,
+    or CALENDAR_PAST_DAYS ago if its calendar was never synced.
     """
-    api_key, host, port = set_env()
-    conn = connect_http(host, port)
-    send_request(f"{api_key}", conn, "/api/v3/calendar")
-    return decode_response(get_response(conn))
+    synced_until = get_sync_state(f"calendar_synced_until:{instance}", db_path)
+    if synced_until is None:
+        return now - timedelta(days=CALENDAR_PAST_DAYS)
+    synced_until = datetime.strptime(synced_until, "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=timezone.utc)
+    return min(synced_until, now) - timedelta(seconds=CALENDAR_SYNC_OVERLAP)
 
-# Flag to control the loop
-running = True
+async def get_calendar(start, end, instance=None):
+    """
+    Retrieve the calendar of a Sonarr instance between start and end, fetching each window at the same time.
+    """
+    pages = await asyncio.gather(*(
+        run_on_host(sonarr_host(instance), fetch_calendar, window_start, window_end, instance)
+        for window_start, window_end in calendar_windows(start, end)
+    ))
+    return list(itertools.chain.from_iterable(pages))
+
+# Debrid submissions that shutdown needs to wait for
+_inflight_submissions = set()
+# Work in flight by episode id and by infoHash, so the same thing is never done twice at once
+_inflight_episodes = {}
+_inflight_hashes = {}
+# Work queued by the webhook listener, as (action, id) tuples, and the loop that consumes it
+_webhook_queue = asyncio.Queue()
+_scheduler_loop = None
+
+def parse_webhook_event(payload):
+    """
+    Turn a Sonarr webhook payload into the work we need to do, as a list of (action, id) tuples.
+    search: look the episode up and search for it
+    series: pull in every episode of a newly added series
+    downloaded: Sonarr grabbed it itself, stop searching
+    """
+    event_type = payload.get("eventType")
+    episode_ids = [episode["id"] for episode in payload.get("episodes", []) if "id" in episode]
+    if event_type == "SeriesAdd" and "id" in payload.get("series", {}):
+        return [("series", payload["series"]["id"])]
+    if event_type == "EpisodeFileDelete" and payload.get("deleteReason") != "upgrade":
+        return [("search", episode_id) for episode_id in episode_ids]
+    if event_type in ("Grab", "Download"):
+        return [("downloaded", episode_id) for episode_id in episode_ids]
+    return []
+
+def get_series_episodes(series_id, instance=None):
+    """
+    Retrieve every episode of a series from a Sonarr instance.
+    """
+    res, body = sonarr_get(f"/api/v3/episode?seriesId={series_id}&includeSeries=true", instance=instance)
+    return json.loads(decode_response(body))
+
+async def handle_webhook_batch(actions, instance=DEFAULT_INSTANCE):
+    """
+    Do the work queued by webhooks from one Sonarr instance. Duplicate events are coalesced, and only the affected episodes are searched.
+    """
+    downloaded = {item_id for action, item_id in actions if action == "downloaded"}
+    search_ids = {item_id for action, item_id in actions if action == "search"} - downloaded
+    series_ids = {item_id for action, item_id in actions if action == "series"}
+    if downloaded:
+        print(f"Sonarr grabbed {len(downloaded)} episodes itself, no longer searching for them")
+        mark_downloaded(downloaded, instance=instance)
+
+    entries = [{"id": episode_id, "instance": instance} for episode_id in search_ids]
+    for series_episodes in await asyncio.gather(*(run_on_host(sonarr_host(instance), get_series_episodes, series_id, instance) for series_id in series_ids)):
+        # Like the calendar, only what Sonarr is still looking for. Unmonitored episodes and ones with a file are left alone
+        entries.extend(episode for episode in series_episodes if episode.get("monitored") and not episode.get("hasFile"))
+    if not entries:
+        return
+    mark_pending(search_ids, instance=instance)
+    aired = await loop_through_calendar(entries, instance)
+    pending = [find_episode(episode["id"], instance=instance) for episode in aired]
+    await loop_episodes([episode for episode in pending if episode and not episode["has_downloaded"]])
+
+def queue_webhook_actions(actions, instance=DEFAULT_INSTANCE):
+    """
+    Add webhook work from a Sonarr instance to the queue. Runs on the scheduler loop.
+    """
+    for action in actions:
+        _webhook_queue.put_nowait((instance, action))
+    set_gauge("queue_depth", _webhook_queue.qsize(), queue="webhook")
+
+async def webhook_dispatcher():
+    """
+    Wait for webhook work and run it, taking everything queued so far as one batch per Sonarr instance.
+    """
+    while True:
+        queued = [await _webhook_queue.get()]
+        while not _webhook_queue.empty():
+            queued.append(_webhook_queue.get_nowait())
+        set_gauge("queue_depth", 0, queue="webhook")
+        batches = {}
+        for instance, action in queued:
+            batches.setdefault(instance, []).append(action)
+        async with loop_lock("cycle"):
+            for instance, actions in batches.items():
+                await run_job("webhook", handle_webhook_batch, actions, instance)
+
+def listener_handler():
+    """
+    Build the request handler for the webhook and /metrics listener.
+    http.server is only imported here, so runs that don't listen never pay for it.
+    """
+    import http.server
+
+    class ListenerHandler(http.server.BaseHTTPRequestHandler):
+        """
+        Accepts Sonarr Connect webhook events and queues the affected episodes, and serves /metrics.
+        """
+
+        def do_GET(self):
+            if urlsplit(self.path).path != "/metrics":
+                self.send_error(404)
+                return
+            body = render_metrics().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            url = urlsplit(self.path)
+            if url.path != "/webhook":
+                self.send_error(404)
+                return
+            query = parse_qs(url.query)
+            if WEBHOOK_TOKEN and query.get("token", [None])[0] != WEBHOOK_TOKEN:
+                self.send_error(401)
+                return
+            # Each Sonarr instance points its webhook at /webhook?instance=<name>
+            instance = query.get("instance", [DEFAULT_INSTANCE])[0]
+            if instance not in sonarr_instances():
+                self.send_error(404)
+                return
+            try:
+                payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            except ValueError:
+                self.send_error(400)
+                return
+            actions = parse_webhook_event(payload)
+            if _scheduler_loop is None:
+                self.send_error(503)
+                return
+            _scheduler_loop.call_soon_threadsafe(queue_webhook_actions, actions, instance)
+            print(f"Webhook {payload.get('eventType')} from {instance}: queued {len(actions)} items")
+            self.send_response(202)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            pass
+
+    return ListenerHandler
+
+def start_http_server(port):
+    """
+    Start the HTTP listener for webhooks and /metrics in the background.
+    """
+    import http.server
+    server = http.server.ThreadingHTTPServer(("0.0.0.0", port), listener_handler())
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def cache_hit_rate(cache):
+    """
+    Share of lookups in the given cache that were hits, None if it hasn't been used.
+    """
+    hits = get_metric("cache_requests_total", cache=cache, result="hit")
+    total = hits + get_metric("cache_requests_total", cache=cache, result="miss")
+    return round(hits / total, 3) if total else None
+
+async def refresh_instance_calendar(instance):
+    """
+    Retrieve what aired on one Sonarr instance since its last sync and add it to the watch list.
+    Entries that haven't changed since they were last seen are skipped.
+    """
+    now = datetime.now(timezone.utc)
+    start = calendar_sync_start(now, instance=instance)
+    calendar = await get_calendar(start, now, instance)
+    for entry in calendar:
+        entry["instance"] = instance
+    changed = changed_calendar_entries(calendar, instance=instance)
+    print(f"Finding shows airing today on {instance}, {len(changed)} of {len(calendar)} calendar entries changed")
+    aired = await loop_through_calendar(changed, instance)
+    # Entries we couldn't get details for aren't marked, and the high-water mark stops at the earliest of them,
+    # so the next sync asks for them again however far back they aired
+    aired_ids = {episode["id"] for episode in aired}
+    mark_calendar_seen([entry for entry in changed if entry["id"] in aired_ids], instance=instance)
+    forget_calendar_before(start, instance=instance)
+    synced_until = now
+    for entry in changed:
+        if entry["id"] not in aired_ids:
+            aired_at = air_timestamp(entry)
+            held = datetime.fromtimestamp(aired_at, timezone.utc) if aired_at is not None else start + timedelta(seconds=CALENDAR_SYNC_OVERLAP)
+            synced_until = min(synced_until, held)
+    set_sync_state(f"calendar_synced_until:{instance}", f"{synced_until:%Y-%m-%dT%H:%M:%SZ}")
+
+async def refresh_calendar():
+    """
+    Sync the calendar of every Sonarr instance at the same time.
+    One instance being down doesn't hold up the others, its error is raised once they're done.
+    """
+    names = list(sonarr_instances())
+    results = await asyncio.gather(*(refresh_instance_calendar(name) for name in names), return_exceptions=True)
+    errors = []
+    for name, result in zip(names, results):
+        if isinstance(result, Exception):
+            print(f"Calendar sync for {name} failed: {result!r}")
+            errors.append(result)
+    if errors:
+        raise errors[0]
+    print("Calendar updated")
+
+async def search_backlog():
+    """
+    Search for everything still on the watch list.
+    """
+    print("Searching backlog")
+    await check_for_torrents()
+    for host, stats in get_pool_stats().items():
+        print(f"Connections to {host}: {stats['opened']} opened, {stats['reused']} reused, {stats['retried']} retried, {stats['dropped']} dropped")
+    print("Finished, see you soon")
 
-async def main():
+async def run_job(name, job, *args):
     """
-    Main function to retrieve the calendar, update it, and check for torrents.
+    Run one job, recording how long it took and what it did. Errors are printed rather than raised
+    so one bad run doesn't stop the scheduler.
     """
+    started = time.monotonic()
+    stages = ("processed", "matched", "sent")
+    before = {stage: get_metric("episodes_total", stage=stage) for stage in stages}
+    ok = False
     try:
-        calendar = await get_calendar()
-        print("Finding shows airing today")
-        time.sleep(5)
-        loop_through_calendar(calendar)
-        print("Calendar updated, searching backlog")
-        time.sleep(5)
-        check_for_torrents()
-        print("Finished, see you soon")
+        await job(*args)
+        ok = True
     except Exception as e:
         traceback.print_exc()
+    duration = time.monotonic() - started
+    episodes = {stage: get_metric("episodes_total", stage=stage) - before[stage] for stage in stages}
+    observe("cycle_duration_seconds", duration, job=name)
+    for stage, count in episodes.items():
+        set_gauge("cycle_episodes", count, job=name, stage=stage)
+    log_event(
+        name, ok=ok, duration=round(duration, 3), episodes=episodes,
+        cache_hit_rate={cache: cache_hit_rate(cache) for cache in ("torrentio", "qualityprofile")},
+        connections=get_pool_stats(),
+    )
+    return ok
+
+def next_run_time(previous, interval, now, mode=None):
+    """
+    Work out when a job should next run.
+    fixed-rate keeps to the original beat and skips any runs that were missed while the last one overran.
+    fixed-delay waits the whole interval after the last run finished.
+    """
+    if (mode or SCHEDULE_MODE) == "fixed-delay":
+        return now + interval
+    next_run = previous + interval
+    if next_run < now:
+        next_run += ((now - next_run) // interval + 1) * interval
+    return next_run
+
+async def run_periodically(name, interval, job, stop, mode=None, jitter=None):
+    """
+    Run a job every interval seconds until stop is set.
+    Jobs share the cycle lock with each other and with webhook batches, so runs never overlap.
+    """
+    loop = asyncio.get_running_loop()
+    jitter = SCHEDULE_JITTER if jitter is None else jitter
+    next_run = loop.time()
+    while not stop.is_set():
+        async with loop_lock("cycle"):
+            await run_job(name, job)
+        next_run = next_run_time(next_run, interval, loop.time(), mode)
+        delay = max(0, next_run - loop.time()) + random.uniform(0, jitter)
+        try:
+            await asyncio.wait_for(stop.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+
+async def run_scheduler():
+    """
+    Run the calendar refresh, backlog search and webhook dispatcher on one event loop until we're told to stop.
+    On shutdown, debrid submissions that are already under way get SHUTDOWN_TIMEOUT seconds to finish.
+    """
+    global _scheduler_loop
+    _scheduler_loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            _scheduler_loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            # Windows has no loop signal handlers, Ctrl+C still raises KeyboardInterrupt there
+            pass
+
+    servers = []
+    tasks = [
+        asyncio.create_task(run_periodically("calendar", CALENDAR_INTERVAL, refresh_calendar, stop)),
+        asyncio.create_task(run_periodically("backlog", BACKLOG_INTERVAL, search_backlog, stop)),
+        asyncio.create_task(library_refresher(stop)),
+    ]
+    if WEBHOOK_PORT:
+        servers.append(start_http_server(WEBHOOK_PORT))
+        tasks.append(asyncio.create_task(webhook_dispatcher()))
+        print(f"Listening for Sonarr webhooks on port {WEBHOOK_PORT}")
+    if METRICS_PORT and METRICS_PORT != WEBHOOK_PORT:
+        servers.append(start_http_server(METRICS_PORT))
+
+    try:
+        await stop.wait()
+    finally:
+        print("Shutting down")
+        _scheduler_loop = None
+        for server in servers:
+            server.shutdown()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        unfinished = await drain_submissions()
+        if unfinished:
+            print(f"Gave up waiting on {unfinished} debrid submissions")
+        # Refreshes still waiting on the mount would be lost, so send them now
+        await refresh_ready_libraries(debounce=False, wait_for_mount=False)
+        close_connections()
+        close_stores()
 
-def start_timer(interval):
+# What each one-shot mode of the command line runs, in order
+ONE_SHOT_JOBS = {
+    "run-once": (("calendar", refresh_calendar), ("backlog", search_backlog)),
+    "calendar-only": (("calendar", refresh_calendar),),
+    "backlog-only": (("backlog", search_backlog),),
+}
+
+async def run_once(jobs):
     """
-    Start a timer to periodically run the main function.
+    Run each job a single time, send the library refreshes they queued and clean up, for cron jobs and systemd timers.
+    Refreshes go out straight away rather than waiting for the mount, so the process doesn't hang around
+    for up to LIBRARY_MOUNT_TIMEOUT and run into the next scheduled run. Returns whether every job worked.
     """
-    global running
+    try:
+        results = []
+        async with loop_lock("cycle"):
+            for name, job in jobs:
+                results.append(await run_job(name, job))
+        await refresh_ready_libraries(debounce=False, wait_for_mount=False)
+    finally:
+        close_connections()
+        close_stores()
+    return all(results)
 
-    def run_main():
-        if running:
-            asyncio.run(main())
-            threading.Timer(interval, run_main).start()
+def parse_args(argv=None):
+    """
+    Read the command line. Without a mode we keep running like we always have.
+    """
+    import argparse
+    parser = argparse.ArgumentParser(description="Send aired Sonarr episodes to Real-Debrid.")
+    parser.add_argument("mode", nargs="?", default="daemon", choices=["daemon", *ONE_SHOT_JOBS],
+                        help="daemon keeps polling until stopped, the others run once and exit (default: daemon)")
+    parser.add_argument("--dry-run", action="store_true", help="search and rank torrents without sending anything to Real-Debrid")
+    return parser.parse_args(argv)
 
-    run_main()
+def cli(argv=None):
+    """
+    Command line entry point. Returns the exit status, 1 if a one-shot job failed and 2 if the Sonarr instances
+    can't be loaded.
+    """
+    global DRY_RUN
+    args = parse_args(argv)
+    DRY_RUN = DRY_RUN or args.dry_run
+    try:
+        sonarr_instances()
+    except ValueError as e:
+        print(f"Can't start: {e}")
+        return 2
+    try:
+        if args.mode == "daemon":
+            asyncio.run(run_scheduler())
+        elif not asyncio.run(run_once(ONE_SHOT_JOBS[args.mode])):
+            return 1
+    except KeyboardInterrupt:
+        pass
+    return 0
 
-try:
-    start_timer(600) #how long before each run to wait
-except KeyboardInterrupt:
-    running = False
-    sys.exit()
+if __name__ == "__main__":
+    raise SystemExit(cli())
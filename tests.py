@@ -1,19 +1,60 @@
 import unittest
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, MagicMock, ANY
 from main import (
     set_env, connect_http, send_request, get_response, decode_response,
     has_aired, see_if_imdb_exists, get_json, save_json, insert_episode,
     send_torrent_io_request, check_torrentio, sort_results_by_seeders,
-    filter_hdr, remove_different_languages, loop_results, find_magnet
+    filter_hdr, remove_different_languages, loop_results, find_magnet,
+    loop_episodes, run_on_host, get_store, close_stores, find_episode,
+    load_episodes, mark_downloaded, export_json, get_profile_terms,
+    refresh_profile_cache, pooled_request, get_pool_stats, checkout_connection,
+    release_connection, close_connections, calendar_windows, loop_through_calendar,
+    parse_stream, rank_streams, compile_banned_words, get_cached_torrentio,
+    cache_torrentio_result, parse_webhook_event, handle_webhook_batch,
+    observe, inc_counter, render_metrics, log_event, next_run_time,
+    run_periodically, submit_episode, drain_submissions, prefer_cached_streams,
+    debrid_call, DebridRateLimited, DebridError, parse_pack, submit_episodes, mark_pending,
+    was_submitted, process_episode, is_downloaded, refresh_calendar,
+    get_sync_state, CALENDAR_SYNC_OVERLAP, iter_json_items, select_streams,
+    load_sonarr_instances, filter_key, queue_library_refresh, refresh_ready_libraries,
+    update_library, load_backlog, record_search, BACKLOG_SLOW_AFTER, BACKLOG_SLOW_INTERVAL,
+    compile_quality_preference, score_candidates, load_score_weights,
+    cli, parse_args, refresh_calendar, search_backlog, insert_episodes, set_episode_state,
+    check_for_torrents, load_unfinished_submissions, resume_submissions
 )
-from datetime import datetime, timedelta
-import pytz
+import asyncio
+import http.client
+import http.server
+import threading
+import time
+from datetime import datetime, timedelta, timezone
 import os
 import json
+import io
+import tempfile
+
+
+def torrentio_reply(streams):
+    """
+    Stand in for check_torrentio, handing the reader a response body to parse.
+    """
+    body = json.dumps({"streams": streams}).encode("utf-8")
+    return lambda imdb_id, season, episode, read: read(io.BytesIO(body))
 
 
 class TestScript(unittest.TestCase):
 
+    def setUp(self):
+        # Keep every test away from the real data.db
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db_patch = patch('main.DB_PATH', os.path.join(self.tmp.name, 'data.db'))
+        self.db_patch.start()
+
+    def tearDown(self):
+        close_stores()
+        self.db_patch.stop()
+        self.tmp.cleanup()
+
     @patch('os.getenv')
     def test_set_env(self, mock_getenv):
         mock_getenv.side_effect = lambda key, default=None: {
@@ -46,8 +87,8 @@ class TestScript(unittest.TestCase):
         self.assertEqual(decoded, '{"key": "value"}')
 
     def test_has_aired(self):
-        future_date = (datetime.now(pytz.UTC) + timedelta(days=1)).strftime("%Y-%m-%dT%H:%M:%SZ")
-        past_date = (datetime.now(pytz.UTC) - timedelta(days=1)).strftime("%Y-%m-%dT%H:%M:%SZ")
+        future_date = (datetime.now(timezone.utc) + timedelta(days=1)).strftime("%Y-%m-%dT%H:%M:%SZ")
+        past_date = (datetime.now(timezone.utc) - timedelta(days=1)).strftime("%Y-%m-%dT%H:%M:%SZ")
         
         self.assertFalse(has_aired({'airDateUtc': future_date}))
         self.assertTrue(has_aired({'airDateUtc': past_date}))
@@ -65,21 +106,60 @@ class TestScript(unittest.TestCase):
         self.assertEqual(data, [])
         mock_open.assert_called_once_with('data.json', 'r')
 
-    @patch('builtins.open', new_callable=unittest.mock.mock_open)
-    @patch('json.dump')
-    def test_save_json(self, mock_json_dump, mock_open):
-        data = [{"id": 1}]
-        save_json(data, 'data.json')
-        mock_open.assert_called_once_with('data.json', 'w')
-        mock_json_dump.assert_called_once_with(data, mock_open(), indent=4)
-
-    @patch('main.get_json', return_value=[])
-    @patch('main.save_json')
-    def test_insert_episode(self, mock_save_json, mock_get_json):
-        episode = {"id": 1, "series": {"title": "Test Series"}, "seasonNumber": 1, "episodeNumber": 1}
-        insert_episode(episode, 'data.json')
-        mock_get_json.assert_called_once_with('data.json')
-        mock_save_json.assert_called_once()
+    def test_get_json_refuses_corrupt_file(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            json_path = os.path.join(tmp, 'data.json')
+            self.assertEqual(get_json(json_path), [])
+            with open(json_path, 'w') as file:
+                file.write('[{"id": 1}, {"id"')
+            with self.assertRaises(ValueError):
+                get_json(json_path)
+            # A store isn't created around a watch list we couldn't read, so it's imported once the file is fixed
+            db_path = os.path.join(tmp, 'data.db')
+            with patch('main.get_json', side_effect=lambda file_path='data.json': get_json(json_path)):
+                with self.assertRaises(ValueError):
+                    get_store(db_path)
+                save_json([{"id": 1}], json_path)
+                self.assertEqual([e["id"] for e in load_episodes(db_path=db_path)], [1])
+            close_stores()
+
+    def test_save_json(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            json_path = os.path.join(tmp, 'data.json')
+            save_json([{"id": 1}], json_path)
+            # A write that fails part way leaves the old file alone
+            with patch('json.dump', side_effect=lambda data, file, indent: file.write('[{"id"') and 1 / 0):
+                with self.assertRaises(ZeroDivisionError):
+                    save_json([{"id": 2}], json_path)
+            self.assertEqual(get_json(json_path), [{"id": 1}])
+            save_json([{"id": 2}], json_path)
+            self.assertEqual(get_json(json_path), [{"id": 2}])
+            self.assertEqual(os.listdir(tmp), ['data.json'])
+
+    def test_insert_episode(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            db_path = os.path.join(tmp, 'data.db')
+            episode = {"id": 1, "series": {"title": "Test Series"}, "seasonNumber": 1, "episodeNumber": 1}
+            insert_episode(episode, db_path)
+            insert_episode(dict(episode, seasonNumber=9), db_path)
+            stored = find_episode(1, db_path)
+            self.assertEqual(stored["seasonNumber"], 1)
+            self.assertFalse(stored["has_downloaded"])
+            close_stores()
+
+    def test_store_imports_and_marks_downloaded(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            db_path = os.path.join(tmp, 'data.db')
+            json_path = os.path.join(tmp, 'data.json')
+            save_json([{"id": 1, "has_downloaded": False}, {"id": 2, "has_downloaded": True}], json_path)
+            with patch('main.get_json', side_effect=lambda file_path='data.json': get_json(json_path)):
+                get_store(db_path)
+            self.assertEqual([e["id"] for e in load_episodes(pending_only=True, db_path=db_path)], [1])
+            mark_downloaded([1], db_path)
+            self.assertEqual(load_episodes(pending_only=True, db_path=db_path), [])
+            export_json(json_path, db_path)
+            self.assertEqual(get_json(json_path), [{"id": 1, "has_downloaded": True}, {"id": 2, "has_downloaded": True}])
+            close_stores()
 
     @patch('http.client.HTTPSConnection')
     def test_send_torrent_io_request(self, mock_https_connection):
@@ -125,6 +205,858 @@ class TestScript(unittest.TestCase):
         magnet = find_magnet(torrent)
         self.assertEqual(magnet, "magnet:?xt=urn:btih:12345")
 
+    def test_run_on_host_respects_limit(self):
+        active = []
+        peak = []
+
+        def blocking_call():
+            active.append(1)
+            peak.append(len(active))
+            time.sleep(0.05)
+            active.pop()
+
+        async def run_all():
+            await asyncio.gather(*(run_on_host("jellyfin", blocking_call) for _ in range(3)))
+
+        asyncio.run(run_all())
+        self.assertEqual(max(peak), 1)
+
+    @patch('main.queue_library_refresh')
+    @patch('main.remove_episodes')
+    @patch('main.get_instant_availability', side_effect=lambda hashes: {h: False for h in hashes})
+    @patch('main.start_torrent_download')
+    @patch('main.send_magnet_debrid', return_value='{"id": "abc"}')
+    @patch('main.fetch_quality_profile', return_value=({"items": [{"allowed": True, "items": [], "quality": {"name": "WEBDL-1080p"}}]}, None))
+    @patch('main.check_torrentio')
+    def test_loop_episodes(self, mock_torrentio, mock_profile, mock_send, mock_start, mock_availability, mock_remove, mock_update):
+        mock_torrentio.side_effect = torrentio_reply([
+            {"title": "Show S01E01 1080p WEBDL 👤 5 ", "infoHash": "low"},
+            {"title": "Show S01E01 1080p WEBDL 👤 50 ", "infoHash": "high"},
+        ])
+        series = {"title": "Show", "imdbId": "tt1", "qualityProfileId": 1}
+        data = [
+            {"id": 1, "series": series, "seasonNumber": 1, "episodeNumber": 1, "has_downloaded": False},
+            {"id": 2, "series": series, "seasonNumber": 1, "episodeNumber": 2, "has_downloaded": True},
+        ]
+        refresh_profile_cache()
+        with tempfile.TemporaryDirectory() as tmp, patch('main.DB_PATH', os.path.join(tmp, 'data.db')):
+            asyncio.run(loop_episodes(data))
+            close_stores()
+        mock_torrentio.assert_called_once_with("tt1", 1, 1, ANY)
+        mock_send.assert_called_once_with("magnet:?xt=urn:btih:high")
+        mock_remove.assert_called_once_with([data[0]])
+        mock_update.assert_called_once_with([data[0]], None)
+
+    @patch('main.fetch_quality_profile')
+    def test_profile_terms_are_cached(self, mock_fetch):
+        profile = {"items": [{"allowed": True, "items": [], "quality": {"name": "WEBDL-1080p"}}]}
+        mock_fetch.return_value = (profile, '"v1"')
+        refresh_profile_cache()
+
+        async def lookups():
+            return await asyncio.gather(*(get_profile_terms(7) for _ in range(5)))
+
+        results = asyncio.run(lookups())
+        self.assertEqual(results[0], ["WEBDL", "1080p"])
+        mock_fetch.assert_called_once_with(7, None, None)
+
+        # An expired entry is revalidated with its ETag and kept when Sonarr says 304
+        with patch('main.PROFILE_CACHE_TTL', -1):
+            refresh_profile_cache(7)
+            asyncio.run(get_profile_terms(7))
+        mock_fetch.return_value = (None, '"v1"')
+        self.assertEqual(asyncio.run(get_profile_terms(7)), ["WEBDL", "1080p"])
+        mock_fetch.assert_called_with(7, '"v1"', None)
+        refresh_profile_cache()
+
+    def test_pooled_request_reuses_and_retries(self):
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header("Content-Length", "2")
+                self.end_headers()
+                self.wfile.write(b"ok")
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        port = server.server_address[1]
+        send = lambda conn: conn.request("GET", "/")
+        try:
+            for _ in range(3):
+                res, body = pooled_request("127.0.0.1", port, send)
+                self.assertEqual(body, b"ok")
+            stats = get_pool_stats()[f"127.0.0.1:{port}"]
+            self.assertEqual((stats["opened"], stats["reused"]), (1, 2))
+
+            # Kill the idle socket behind the pool's back, it's dropped before the next request uses it
+            conn, reused = checkout_connection("127.0.0.1", port)
+            conn.sock.close()
+            release_connection(conn, "127.0.0.1", port)
+            res, body = pooled_request("127.0.0.1", port, send)
+            self.assertEqual(body, b"ok")
+            self.assertEqual(get_pool_stats()[f"127.0.0.1:{port}"]["dropped"], 1)
+
+            # One that dies after the check is retried on a new one
+            conn, reused = checkout_connection("127.0.0.1", port)
+            conn.sock.close()
+            release_connection(conn, "127.0.0.1", port)
+            with patch('main.connection_is_dead', return_value=False):
+                res, body = pooled_request("127.0.0.1", port, send)
+            self.assertEqual(body, b"ok")
+            self.assertEqual(get_pool_stats()[f"127.0.0.1:{port}"]["retried"], 1)
+
+            # Connections idle past the timeout aren't reused
+            with patch('main.POOL_IDLE_TIMEOUT', 0):
+                res, body = pooled_request("127.0.0.1", port, send)
+            self.assertEqual(get_pool_stats()[f"127.0.0.1:{port}"]["dropped"], 2)
+        finally:
+            close_connections()
+            server.shutdown()
+            server.server_close()
+
+    def test_pooled_request_doesnt_resend_posts(self):
+        posts = []
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header("Content-Length", "2")
+                self.end_headers()
+                self.wfile.write(b"ok")
+
+            def do_POST(self):
+                # Acts on the request but hangs up before answering
+                posts.append(self.path)
+                self.close_connection = True
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        port = server.server_address[1]
+        try:
+            pooled_request("127.0.0.1", port, lambda conn: conn.request("GET", "/"))
+            with self.assertRaises(http.client.RemoteDisconnected):
+                pooled_request("127.0.0.1", port, lambda conn: conn.request("POST", "/add", ""), idempotent=False)
+            self.assertEqual(posts, ["/add"])
+        finally:
+            close_connections()
+            server.shutdown()
+            server.server_close()
+
+    def test_pooled_request_posts_after_server_closed_idle_connection(self):
+        posts = []
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Hang up on keep-alive connections nobody uses for a moment
+            timeout = 0.1
+
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header("Content-Length", "2")
+                self.end_headers()
+                self.wfile.write(b"ok")
+
+            def do_POST(self):
+                posts.append(self.path)
+                self.do_GET()
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        port = server.server_address[1]
+        try:
+            pooled_request("127.0.0.1", port, lambda conn: conn.request("GET", "/"))
+            time.sleep(0.3)
+            res, body = pooled_request("127.0.0.1", port, lambda conn: conn.request("POST", "/add", ""), idempotent=False)
+            self.assertEqual((body, posts), (b"ok", ["/add"]))
+            stats = get_pool_stats()[f"127.0.0.1:{port}"]
+            self.assertEqual((stats["opened"], stats["dropped"]), (2, 1))
+        finally:
+            close_connections()
+            server.shutdown()
+            server.server_close()
+
+    def test_calendar_windows(self):
+        start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+        windows = calendar_windows(start, start + timedelta(days=10), days=7)
+        self.assertEqual(windows, [
+            (start, start + timedelta(days=7)),
+            (start + timedelta(days=7), start + timedelta(days=10)),
+        ])
+
+    @patch('main.insert_episodes')
+    @patch('main.get_episode_details')
+    def test_loop_through_calendar_only_fetches_incomplete_entries(self, mock_details, mock_insert):
+        past = (datetime.now(timezone.utc) - timedelta(days=1)).strftime("%Y-%m-%dT%H:%M:%SZ")
+        future = (datetime.now(timezone.utc) + timedelta(days=1)).strftime("%Y-%m-%dT%H:%M:%SZ")
+        series = {"title": "Show", "imdbId": "tt1", "qualityProfileId": 1}
+        complete = {"id": 1, "seasonNumber": 1, "episodeNumber": 1, "airDateUtc": past, "series": series}
+        unaired = {"id": 2, "seasonNumber": 1, "episodeNumber": 2, "airDateUtc": future, "series": series}
+        partial = {"id": 3, "seasonNumber": 1, "episodeNumber": 3, "airDateUtc": past}
+        mock_details.return_value = dict(partial, series=series)
+
+        asyncio.run(loop_through_calendar([complete, unaired, partial]))
+        mock_details.assert_called_once_with(partial)
+        mock_insert.assert_called_once_with([complete, dict(partial, series=series)])
+
+    def test_parse_stream(self):
+        stream = {
+            "name": "Torrentio\n4k",
+            "title": "Show.S01E01.HDR.WEB-DL.x265\n👤 42 💾 1.5 GB ⚙️ ThePirateBay\nMulti Audio / 🇮🇹 / 🇬🇧",
+            "infoHash": "abc",
+        }
+        record = parse_stream(stream, {"banned": compile_banned_words('["/ 🇮🇹"]'), "allow_hdr": True})
+        self.assertEqual(record.seeders, 42)
+        self.assertEqual(record.size, 1.5)
+        self.assertEqual(record.resolution, "4k")
+        self.assertEqual(record.source, "webdl")
+        self.assertTrue(record.hdr)
+        self.assertEqual(record.languages, ("🇮🇹", "🇬🇧"))
+        self.assertTrue(record.banned)
+        self.assertIs(record.stream, stream)
+
+    def test_rank_streams(self):
+        streams = [
+            {"title": "Show 1080p WEBDL 👤 5"},
+            {"title": "Show 1080p WEBDL HDR 👤 90"},
+            {"title": "Show 1080p WEBDL / 🇷🇺 👤 80"},
+            {"title": "Show 720p HDTV 👤 70"},
+            {"title": "Show 1080p WEBDL 👤 30"},
+        ]
+        matchers = {"banned": compile_banned_words('["/ 🇷🇺"]'), "allow_hdr": False}
+        ranked = rank_streams(streams, ["WEBDL", "1080p"], matchers)
+        self.assertEqual([record.seeders for record in ranked], [30, 5])
+
+    def test_torrentio_cache_backoff_and_eviction(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            db_path = os.path.join(tmp, 'data.db')
+            self.assertIsNone(get_cached_torrentio("tt1:1:1", db_path))
+            self.assertEqual(cache_torrentio_result("tt1:1:1", '{"streams": []}', False, db_path), 1800)
+            self.assertEqual(cache_torrentio_result("tt1:1:1", '{"streams": []}', False, db_path), 3600)
+            self.assertEqual(get_cached_torrentio("tt1:1:1", db_path), '{"streams": []}')
+            # A match resets the backoff
+            self.assertEqual(cache_torrentio_result("tt1:1:1", '{"streams": [1]}', True, db_path), 3600)
+            self.assertEqual(cache_torrentio_result("tt1:1:1", '{"streams": []}', False, db_path), 1800)
+
+            with patch('main.TORRENTIO_CACHE_SIZE', 2):
+                cache_torrentio_result("tt2:1:1", "{}", True, db_path)
+                get_cached_torrentio("tt1:1:1", db_path)
+                cache_torrentio_result("tt3:1:1", "{}", True, db_path)
+            self.assertIsNone(get_cached_torrentio("tt2:1:1", db_path))
+            self.assertIsNotNone(get_cached_torrentio("tt1:1:1", db_path))
+            close_stores()
+
+    def test_parse_webhook_event(self):
+        episodes = [{"id": 11}, {"id": 12}]
+        self.assertEqual(parse_webhook_event({"eventType": "SeriesAdd", "series": {"id": 3}}), [("series", 3)])
+        self.assertEqual(parse_webhook_event({"eventType": "EpisodeFileDelete", "deleteReason": "manual", "episodes": episodes}),
+                         [("search", 11), ("search", 12)])
+        self.assertEqual(parse_webhook_event({"eventType": "EpisodeFileDelete", "deleteReason": "upgrade", "episodes": episodes}), [])
+        self.assertEqual(parse_webhook_event({"eventType": "Grab", "episodes": episodes}), [("downloaded", 11), ("downloaded", 12)])
+        self.assertEqual(parse_webhook_event({"eventType": "Test"}), [])
+
+    @patch('main.loop_episodes')
+    @patch('main.get_episode_details')
+    def test_handle_webhook_batch(self, mock_details, mock_loop):
+        past = (datetime.now(timezone.utc) - timedelta(days=1)).strftime("%Y-%m-%dT%H:%M:%SZ")
+        series = {"title": "Show", "imdbId": "tt1", "qualityProfileId": 1}
+        mock_details.side_effect = lambda show: {"id": show["id"], "seasonNumber": 1, "episodeNumber": show["id"], "airDateUtc": past, "series": series}
+        with tempfile.TemporaryDirectory() as tmp, patch('main.DB_PATH', os.path.join(tmp, 'data.db')):
+            insert_episode(mock_details({"id": 1}))
+            mark_downloaded([1])
+            asyncio.run(handle_webhook_batch([("search", 1), ("search", 2), ("search", 2), ("downloaded", 3)]))
+            searched = mock_loop.call_args[0][0]
+            self.assertEqual(sorted(episode["id"] for episode in searched), [1, 2])
+            close_stores()
+
+    @patch('main.loop_episodes')
+    @patch('main.get_series_episodes')
+    def test_series_add_only_searches_wanted_episodes(self, mock_series, mock_loop):
+        past = (datetime.now(timezone.utc) - timedelta(days=1)).strftime("%Y-%m-%dT%H:%M:%SZ")
+        series = {"title": "Show", "imdbId": "tt1", "qualityProfileId": 1}
+        episode = lambda episode_id, **fields: dict({"id": episode_id, "seasonNumber": 1, "episodeNumber": episode_id, "airDateUtc": past,
+                                                     "series": series, "monitored": True, "hasFile": False}, **fields)
+        mock_series.return_value = [episode(1), episode(2, monitored=False), episode(3, hasFile=True), episode(4, seasonNumber=0, monitored=False)]
+        asyncio.run(handle_webhook_batch([("series", 7)]))
+        mock_series.assert_called_once_with(7, "default")
+        self.assertEqual([episode["id"] for episode in mock_loop.call_args[0][0]], [1])
+        self.assertEqual([episode["id"] for episode in load_episodes()], [1])
+
+    def test_render_metrics(self):
+        observe("http_request_duration_seconds", 0.2, host="test", endpoint="/metrics-test")
+        inc_counter("http_requests_total", host="test", endpoint="/metrics-test", status=200)
+        inc_counter("http_requests_total", host="test", endpoint="/metrics-test", status="error")
+        text = render_metrics()
+        self.assertIn("# TYPE http_request_duration_seconds histogram", text)
+        self.assertIn('http_request_duration_seconds_bucket{endpoint="/metrics-test",host="test",le="0.25"} 1', text)
+        self.assertIn('http_request_duration_seconds_bucket{endpoint="/metrics-test",host="test",le="0.1"} 0', text)
+        self.assertIn('http_requests_total{endpoint="/metrics-test",host="test",status="200"} 1', text)
+
+    def test_log_event(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            log_path = os.path.join(tmp, 'metrics.jsonl')
+            with patch('main.METRICS_LOG', log_path):
+                log_event("cycle", duration=1.5, episodes={"sent": 2})
+            with open(log_path) as file:
+                line = json.loads(file.readline())
+        self.assertEqual(line["event"], "cycle")
+        self.assertEqual(line["episodes"], {"sent": 2})
+
+    def test_next_run_time(self):
+        self.assertEqual(next_run_time(100, 10, 103, "fixed-rate"), 110)
+        # Overran by two and a half intervals, skip to the next beat instead of running back to back
+        self.assertEqual(next_run_time(100, 10, 135, "fixed-rate"), 140)
+        self.assertEqual(next_run_time(100, 10, 135, "fixed-delay"), 145)
+
+    def test_run_periodically_never_overlaps_and_stops(self):
+        calls = []
+
+        async def job():
+            calls.append(("start", len(calls)))
+            await asyncio.sleep(0.02)
+            calls.append(("end", len(calls)))
+
+        async def run():
+            stop = asyncio.Event()
+            tasks = [
+                asyncio.create_task(run_periodically("a", 0.01, job, stop, jitter=0)),
+                asyncio.create_task(run_periodically("b", 0.01, job, stop, jitter=0)),
+            ]
+            await asyncio.sleep(0.15)
+            stop.set()
+            await asyncio.wait_for(asyncio.gather(*tasks), 1)
+
+        asyncio.run(run())
+        kinds = [kind for kind, _ in calls]
+        self.assertGreater(len(kinds), 4)
+        self.assertEqual(kinds[:len(kinds) // 2 * 2], ["start", "end"] * (len(kinds) // 2))
+
+    @patch('main.remove_episodes')
+    @patch('main.start_torrent_download')
+    @patch('main.send_magnet_debrid')
+    def test_submission_survives_cancellation(self, mock_send, mock_start, mock_remove):
+        mock_send.side_effect = lambda magnet: time.sleep(0.05) or '{"id": "x"}'
+        episode = {"id": 1, "series": {"title": "Show"}, "seasonNumber": 1, "episodeNumber": 1}
+
+        async def run():
+            cycle = asyncio.create_task(submit_episode(episode, "magnet:?xt=urn:btih:x"))
+            await asyncio.sleep(0.01)
+            cycle.cancel()
+            self.assertEqual(await drain_submissions(1), 0)
+
+        asyncio.run(run())
+        mock_start.assert_called_once()
+        mock_remove.assert_called_once_with([episode])
+
+    @patch('main.get_instant_availability')
+    def test_prefer_cached_streams(self, mock_availability):
+        mock_availability.side_effect = lambda hashes: {h: h in ("b", "d") for h in hashes}
+        candidates = [parse_stream({"title": f"👤 {10 - i}", "infoHash": h}) for i, h in enumerate("abcdef")]
+        with patch('main.RD_AVAILABILITY_TOP_N', 4), patch.dict('main._availability_cache', clear=True):
+            ranked = asyncio.run(prefer_cached_streams(candidates))
+            self.assertEqual([r.stream["infoHash"] for r in ranked], ["b", "d", "a", "c", "e", "f"])
+            mock_availability.assert_called_once_with(["a", "b", "c", "d"])
+            # Answers are cached per hash
+            asyncio.run(prefer_cached_streams(candidates))
+            mock_availability.assert_called_once()
+
+    @patch('main.get_instant_availability', side_effect=OSError("down"))
+    def test_prefer_cached_streams_keeps_order_when_check_fails(self, mock_availability):
+        candidates = [parse_stream({"title": f"👤 {10 - i}", "infoHash": h}) for i, h in enumerate("ab")]
+        with patch.dict('main._availability_cache', clear=True):
+            self.assertEqual(asyncio.run(prefer_cached_streams(candidates)), candidates)
+
+    def test_debrid_call_retries_rate_limits(self):
+        responses = [DebridRateLimited(0.01), DebridRateLimited(0.01), "ok"]
+
+        def rd_call():
+            response = responses.pop(0)
+            if isinstance(response, Exception):
+                raise response
+            return response
+
+        self.assertEqual(asyncio.run(debrid_call(rd_call)), "ok")
+        self.assertEqual(responses, [])
+
+    def test_parse_pack(self):
+        self.assertIsNone(parse_pack("Show.S01E05.1080p.WEB-DL"))
+        self.assertEqual(parse_pack("Show.S01E01-E06.1080p"), (1, (1, 6)))
+        self.assertEqual(parse_pack("Show.S02.1080p.BluRay"), (2, None))
+        self.assertEqual(parse_pack("Show Season 3 Complete 720p"), (3, None))
+        self.assertIsNone(parse_pack("Show 2019 1080p"))
+        # Single episodes numbered after the season marker aren't season packs
+        self.assertIsNone(parse_pack("[SubsPlease] Show S2 - 05 (1080p)"))
+        self.assertIsNone(parse_pack("Show Season 1 Episode 5"))
+        self.assertIsNone(parse_pack("Show S01 EP05"))
+        self.assertEqual(parse_pack("Show S02 - 720p"), (2, None))
+        # A resolution after the episode isn't the end of a range
+        self.assertIsNone(parse_pack("Show.S01E05-720p"))
+        self.assertEqual(parse_pack("Show.S01E01-06.1080p"), (1, (1, 6)))
+
+    @patch('main.queue_library_refresh')
+    @patch('main.remove_episodes')
+    @patch('main.get_instant_availability', side_effect=lambda hashes: {h: False for h in hashes})
+    @patch('main.get_torrent_info', return_value={"files": [{"path": f"/Show.S01E0{n}.mkv"} for n in range(1, 6)]})
+    @patch('main.start_torrent_download')
+    @patch('main.send_magnet_debrid', return_value='{"id": "abc"}')
+    @patch('main.fetch_quality_profile', return_value=({"items": [{"allowed": True, "items": [], "quality": {"name": "WEBDL-1080p"}}]}, None))
+    @patch('main.check_torrentio')
+    def test_loop_episodes_sends_season_pack(self, mock_torrentio, mock_profile, mock_send, mock_start, mock_info, mock_availability, mock_remove, mock_update):
+        mock_torrentio.side_effect = torrentio_reply([
+            {"title": "Show.S01E01.1080p.WEBDL\n👤 90", "infoHash": "single"},
+            {"title": "Show.S01E01-E03.1080p.WEBDL\nShow.S01E01.mkv\n👤 40", "infoHash": "partial"},
+            {"title": "Show.S01.1080p.WEBDL\nShow.S01E01.mkv\n👤 20", "infoHash": "season"},
+        ])
+        series = {"title": "Show", "imdbId": "tt1", "qualityProfileId": 1}
+        data = [{"id": n, "series": series, "seasonNumber": 1, "episodeNumber": n, "has_downloaded": False} for n in range(1, 6)]
+        refresh_profile_cache()
+        with tempfile.TemporaryDirectory() as tmp, patch('main.DB_PATH', os.path.join(tmp, 'data.db')):
+            asyncio.run(loop_episodes(data))
+            close_stores()
+        mock_torrentio.assert_called_once_with("tt1", 1, 1, ANY)
+        mock_send.assert_called_once_with("magnet:?xt=urn:btih:season")
+        mock_remove.assert_called_once_with(data)
+        mock_update.assert_called_once_with(data, None)
+
+    def test_cli_modes(self):
+        self.assertEqual(parse_args([]).mode, "daemon")
+        self.assertFalse(parse_args([]).dry_run)
+        with self.assertRaises(SystemExit):
+            parse_args(["sometimes"])
+
+        ran = []
+
+        async def fake_job(name, job):
+            ran.append((name, job))
+            return name != "calendar"
+
+        with patch('main.run_job', side_effect=fake_job), patch('main.close_stores'), patch('main.DRY_RUN', False), \
+                patch('main.refresh_ready_libraries') as mock_refresh:
+            self.assertEqual(cli(["backlog-only", "--dry-run"]), 0)
+            self.assertEqual(ran, [("backlog", search_backlog)])
+            # One-shot runs don't sit waiting for the mount
+            mock_refresh.assert_awaited_once_with(debounce=False, wait_for_mount=False)
+            import main
+            self.assertTrue(main.DRY_RUN)
+            # A failed job fails the run, so a systemd timer or CronJob can see it
+            ran.clear()
+            self.assertEqual(cli(["run-once"]), 1)
+            self.assertEqual(ran, [("calendar", refresh_calendar), ("backlog", search_backlog)])
+
+            # Sonarr instances that can't be used stop it before anything runs
+            ran.clear()
+            with patch.dict(os.environ, {"SONARR_INSTANCES": '[{"name": "4k"}]'}), patch('main._sonarr_instances', None):
+                self.assertEqual(cli(["run-once"]), 2)
+            self.assertEqual(ran, [])
+
+    @patch('main.remove_episodes')
+    @patch('main.send_magnet_debrid')
+    def test_dry_run_sends_nothing(self, mock_send, mock_remove):
+        episode = {"id": 1, "series": {"title": "Show"}, "seasonNumber": 1, "episodeNumber": 1}
+        with patch('main.DRY_RUN', True):
+            asyncio.run(submit_episodes([episode], "magnet:?xt=urn:btih:abc"))
+        mock_send.assert_not_called()
+        mock_remove.assert_not_called()
+        self.assertFalse(was_submitted("abc"))
+
+    @patch('main.start_torrent_download')
+    @patch('main.send_magnet_debrid')
+    def test_submission_steps_are_journaled(self, mock_send, mock_start):
+        episode = {"id": 1, "series": {"title": "Show"}, "seasonNumber": 1, "episodeNumber": 1, "has_downloaded": False}
+        insert_episodes([dict(episode)])
+        state = lambda: get_store().execute("SELECT state, magnet, torrent_id FROM episodes WHERE id = 1").fetchone()
+        # Each step is on disk before the next request goes out
+        mock_send.side_effect = lambda magnet: self.assertEqual(state(), ("searching", magnet, None)) or '{"id": "RD1"}'
+        mock_start.side_effect = lambda torrent_id: self.assertEqual(state(), ("submitted", "magnet:?xt=urn:btih:abc", "RD1"))
+        asyncio.run(submit_episodes([episode], "magnet:?xt=urn:btih:abc"))
+        mock_start.assert_called_once_with("RD1")
+        self.assertEqual(state(), ("done", "magnet:?xt=urn:btih:abc", "RD1"))
+
+        # RD turning the magnet down puts the episode back on the backlog
+        mark_pending([1])
+        mock_send.side_effect = DebridRateLimited(1)
+        with patch('main.RD_MAX_RETRIES', 0), self.assertRaises(DebridRateLimited):
+            asyncio.run(submit_episodes([episode], "magnet:?xt=urn:btih:abc"))
+        self.assertEqual(state()[0], "queued")
+        self.assertEqual([e["id"] for e in load_backlog()], [1])
+
+    @patch('main.start_torrent_download')
+    @patch('main.pooled_request')
+    def test_refused_magnet_goes_back_to_the_backlog(self, mock_request, mock_start):
+        response = MagicMock(status=403)
+        mock_request.return_value = (response, b'{"error": "infringing_file", "error_code": 35}')
+        episode = {"id": 1, "series": {"title": "Show"}, "seasonNumber": 1, "episodeNumber": 1, "has_downloaded": False}
+        insert_episodes([dict(episode)])
+        with self.assertRaises(DebridError) as caught:
+            asyncio.run(submit_episodes([episode], "magnet:?xt=urn:btih:abc"))
+        self.assertEqual(caught.exception.status, 403)
+        mock_start.assert_not_called()
+        self.assertEqual(get_store().execute("SELECT state FROM episodes WHERE id = 1").fetchone(), ("queued",))
+        self.assertEqual([e["id"] for e in load_backlog()], [1])
+        self.assertEqual(load_unfinished_submissions(), [])
+
+        # A success without a torrent id is no better
+        response.status = 200
+        mock_request.return_value = (response, b'{"error": "unknown"}')
+        with self.assertRaises(KeyError):
+            asyncio.run(submit_episodes([episode], "magnet:?xt=urn:btih:abc"))
+        self.assertEqual([e["id"] for e in load_backlog()], [1])
+
+    @patch('main.pooled_request')
+    def test_torrent_rd_wont_start_goes_back_to_the_backlog(self, mock_request):
+        def reply(host, port, send, **kwargs):
+            if kwargs["endpoint"] == "/torrents/addMagnet":
+                return MagicMock(status=201), b'{"id": "RD1"}'
+            return MagicMock(status=404), b'{"error": "unknown_ressource", "error_code": 7}'
+
+        mock_request.side_effect = reply
+        episode = {"id": 1, "series": {"title": "Show"}, "seasonNumber": 1, "episodeNumber": 1, "has_downloaded": False}
+        insert_episodes([dict(episode)])
+        state = lambda: get_store().execute("SELECT state, magnet, torrent_id FROM episodes WHERE id = 1").fetchone()
+        with self.assertRaises(DebridError):
+            asyncio.run(submit_episodes([episode], "magnet:?xt=urn:btih:abc"))
+        self.assertEqual(state(), ("queued", None, None))
+        self.assertEqual(load_unfinished_submissions(), [])
+        self.assertEqual([e["id"] for e in load_backlog()], [1])
+
+        # Same for one resumed after a restart, instead of trying it again every cycle
+        set_episode_state([1], "submitted", magnet="magnet:?xt=urn:btih:abc", torrent_id="RD1")
+        asyncio.run(resume_submissions())
+        self.assertEqual(state(), ("queued", None, None))
+        self.assertEqual(load_unfinished_submissions(), [])
+
+    @patch('main.check_torrentio')
+    @patch('main.get_torrent_info', return_value={"files": []})
+    @patch('main.start_torrent_download')
+    @patch('main.send_magnet_debrid', return_value='{"id": "RD3"}')
+    def test_unfinished_submissions_resume_after_restart(self, mock_send, mock_start, mock_info, mock_torrentio):
+        series = {"title": "Show", "imdbId": "tt1", "qualityProfileId": 1}
+        episodes = [{"id": n, "series": series, "seasonNumber": 1, "episodeNumber": n, "has_downloaded": False} for n in range(1, 5)]
+        insert_episodes([dict(episode) for episode in episodes])
+        # Process died after RD added the pack for 1 and 2 but before it was started, and before adding the torrent for 3
+        set_episode_state([1], "submitted", magnet="magnet:?xt=urn:btih:pack", torrent_id="RD1")
+        set_episode_state([2], "searching", magnet="magnet:?xt=urn:btih:pack")
+        set_episode_state([3], "searching", magnet="magnet:?xt=urn:btih:three")
+        close_stores()
+
+        self.assertEqual([e["id"] for e in load_backlog()], [4])
+        with patch('main.load_backlog', return_value=[]):
+            asyncio.run(check_for_torrents())
+        mock_send.assert_called_once_with("magnet:?xt=urn:btih:three")
+        self.assertEqual(mock_start.call_args_list, [unittest.mock.call("RD1"), unittest.mock.call("RD3")])
+        self.assertEqual([e["id"] for e in load_episodes(pending_only=True)], [4])
+        mock_torrentio.assert_not_called()
+
+    @patch('main.get_torrent_info')
+    @patch('main.start_torrent_download')
+    @patch('main.send_magnet_debrid', return_value='{"id": "RD1"}')
+    def test_episodes_missing_from_a_pack_go_back_to_the_backlog(self, mock_send, mock_start, mock_info):
+        series = {"title": "Show", "imdbId": "tt1", "qualityProfileId": 1}
+        episodes = [{"id": n, "series": series, "seasonNumber": 1, "episodeNumber": n, "has_downloaded": False} for n in range(1, 4)]
+        insert_episodes([dict(episode) for episode in episodes])
+        mock_info.return_value = {"files": [{"path": "/Show.S01E01-E02.mkv"}, {"path": "/Sample.mkv"}]}
+        asyncio.run(submit_episodes(episodes, "magnet:?xt=urn:btih:pack"))
+        mock_info.assert_called_once_with("RD1")
+        self.assertEqual([e["id"] for e in load_episodes(pending_only=True)], [3])
+        self.assertEqual([e["id"] for e in load_backlog()], [3])
+
+    @patch('main.remove_episodes')
+    @patch('main.start_torrent_download')
+    @patch('main.send_magnet_debrid', return_value='{"id": "x"}')
+    def test_same_hash_is_only_sent_once(self, mock_send, mock_start, mock_remove):
+        first = {"id": 1, "series": {"title": "Show"}, "seasonNumber": 1, "episodeNumber": 1}
+        second = {"id": 2, "series": {"title": "Show"}, "seasonNumber": 1, "episodeNumber": 2}
+
+        async def run():
+            await asyncio.gather(
+                submit_episodes([first], "magnet:?xt=urn:btih:ABC"),
+                submit_episodes([second], "magnet:?xt=urn:btih:abc"),
+            )
+
+        asyncio.run(run())
+        mock_send.assert_called_once()
+        self.assertEqual(mock_remove.call_count, 2)
+
+        # Remembered across restarts until the episode is put back on the watch list
+        close_stores()
+        asyncio.run(submit_episodes([first], "magnet:?xt=urn:btih:abc"))
+        mock_send.assert_called_once()
+        mark_pending([2])
+        self.assertFalse(was_submitted("abc"))
+
+    def test_process_episode_single_flights_by_id(self):
+        calls = []
+
+        async def slow_search(episode):
+            calls.append(episode["id"])
+            await asyncio.sleep(0.01)
+            return True
+
+        async def run():
+            episode = {"id": 5}
+            return await asyncio.gather(process_episode(episode), process_episode(dict(episode)))
+
+        with patch('main.search_episode', slow_search):
+            self.assertEqual(asyncio.run(run()), [True, True])
+        self.assertEqual(calls, [5])
+
+    def test_is_downloaded_tracks_store(self):
+        insert_episode({"id": 9, "series": {"title": "Show"}, "seasonNumber": 1, "episodeNumber": 1})
+        self.assertFalse(is_downloaded(9))
+        mark_downloaded([9])
+        self.assertTrue(is_downloaded(9))
+        mark_pending([9])
+        self.assertFalse(is_downloaded(9))
+
+    @patch('main.fetch_calendar')
+    def test_refresh_calendar_is_incremental(self, mock_fetch):
+        past = (datetime.now(timezone.utc) - timedelta(hours=2)).strftime("%Y-%m-%dT%H:%M:%SZ")
+        series = {"title": "Show", "imdbId": "tt1", "qualityProfileId": 1}
+        entry = {"id": 1, "seasonNumber": 1, "episodeNumber": 1, "airDateUtc": past, "hasFile": False, "series": series}
+        mock_fetch.return_value = [entry]
+
+        with patch('main.insert_episodes') as mock_insert:
+            asyncio.run(refresh_calendar())
+            mock_insert.assert_called_once_with([entry])
+        synced_until = get_sync_state("calendar_synced_until:default")
+        self.assertIsNotNone(synced_until)
+
+        # The next sync starts from the saved high-water mark and skips the unchanged entry
+        close_stores()
+        mock_fetch.reset_mock()
+        with patch('main.insert_episodes') as mock_insert:
+            asyncio.run(refresh_calendar())
+            mock_insert.assert_called_once_with([])
+        start = mock_fetch.call_args_list[0].args[0]
+        expected = datetime.strptime(synced_until, "%Y-%m-%dT%H:%M:%SZ") - timedelta(seconds=CALENDAR_SYNC_OVERLAP)
+        self.assertEqual(start.replace(tzinfo=None), expected)
+
+        # A change Sonarr made to the entry brings it back
+        mock_fetch.return_value = [dict(entry, hasFile=True)]
+        with patch('main.insert_episodes') as mock_insert:
+            asyncio.run(refresh_calendar())
+            mock_insert.assert_called_once_with([dict(entry, hasFile=True)])
+
+    @patch('main.get_episode_details')
+    @patch('main.fetch_calendar')
+    def test_refresh_calendar_retries_failed_entries(self, mock_fetch, mock_details):
+        aired = (datetime.now(timezone.utc) - timedelta(hours=20)).strftime("%Y-%m-%dT%H:%M:%SZ")
+        series = {"title": "Show", "imdbId": "tt1", "qualityProfileId": 1}
+        # Missing its series, so the details have to come from Sonarr
+        entry = {"id": 1, "seasonNumber": 1, "episodeNumber": 1, "airDateUtc": aired}
+        mock_fetch.return_value = [entry]
+        mock_details.side_effect = OSError("Sonarr is down")
+        asyncio.run(refresh_calendar())
+        self.assertEqual(get_sync_state("calendar_synced_until:default"), aired)
+
+        # The next sync still reaches back far enough to get it
+        mock_details.side_effect = lambda show: dict(show, series=series)
+        asyncio.run(refresh_calendar())
+        start = mock_fetch.call_args.args[0]
+        self.assertLessEqual(start, datetime.strptime(aired, "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=timezone.utc))
+        self.assertEqual([episode["id"] for episode in load_episodes()], [1])
+        self.assertGreater(get_sync_state("calendar_synced_until:default"), aired)
+
+    def test_iter_json_items_across_chunks(self):
+        body = json.dumps({"cacheMaxAge": 60, "streams": [{"title": "é 👤 1"}, {"title": "b"}, 12345], "other": []}).encode("utf-8")
+        # One byte at a time splits every value and multibyte character
+        chunks = [body[i:i + 1] for i in range(len(body))]
+        self.assertEqual(list(iter_json_items(chunks, "streams")), [{"title": "é 👤 1"}, {"title": "b"}, 12345])
+        self.assertEqual(list(iter_json_items([b'[ ]'])), [])
+        with self.assertRaises(ValueError):
+            list(iter_json_items([b'{"streams": [{"title": '], "streams"))
+
+    def test_select_streams_keeps_top_k(self):
+        streams = [{"title": f"Show 1080p WEBDL 👤 {seeders}", "infoHash": str(i)} for i, seeders in enumerate([5, 50, 20, 50, 1])]
+        matchers = {"banned": None, "allow_hdr": True}
+        candidates, total = select_streams(iter(streams), ["WEBDL", "1080p"], 3, matchers)
+        self.assertEqual(total, 5)
+        # Ties keep Torrentio's order, same as sorting the whole list
+        self.assertEqual([record.stream["infoHash"] for record in candidates], ["1", "3", "2"])
+        self.assertEqual(candidates, rank_streams(streams, ["WEBDL", "1080p"], matchers)[:3])
+
+    def test_score_candidates(self):
+        profile = {"items": [
+            {"allowed": True, "items": [], "quality": {"name": "HDTV-720p"}},
+            {"allowed": False, "items": [], "quality": {"name": "Bluray-2160p"}},
+            {"allowed": True, "name": "WEB 1080p", "items": [{"quality": {"name": "WEBRip-1080p"}}, {"quality": {"name": "WEBDL-1080p"}}]},
+        ]}
+        preference = compile_quality_preference(profile)
+        self.assertEqual(preference, {("hdtv", "720p"): 1, (None, "720p"): 1, ("webrip", "1080p"): 2, ("webdl", "1080p"): 2, (None, "1080p"): 2})
+        matchers = {"banned": None, "allow_hdr": True}
+        episode = [parse_stream({"title": title, "infoHash": title}, matchers) for title in (
+            "Show 720p HDTV 👤 500 💾 1 GB",
+            "Show 1080p WEBDL 👤 40 💾 2 GB",
+            "Show 1080p 👤 40 💾 2 GB",
+            "Show 1080p WEBDL 👤 40 💾 2 GB again",
+        )]
+        # Spread over ten episodes, the pack's size doesn't count for much
+        other = [parse_stream({"title": title, "infoHash": title}, matchers) for title in (
+            "Show.S01.1080p.WEBDL\n👤 10 💾 20 GB",
+            "Show.S01E01.1080p.WEBDL\n👤 10 💾 2.5 GB",
+        )]
+        ranked = score_candidates([episode, [], other], preference)
+        # The profile's preferred quality beats more seeders, equal scores keep their order
+        self.assertEqual([record.stream["infoHash"] for record in ranked[0]], [
+            "Show 1080p WEBDL 👤 40 💾 2 GB", "Show 1080p WEBDL 👤 40 💾 2 GB again", "Show 1080p 👤 40 💾 2 GB", "Show 720p HDTV 👤 500 💾 1 GB"])
+        self.assertEqual(ranked[1], [])
+        self.assertEqual([record.stream["infoHash"] for record in ranked[2]], [other[1].stream["infoHash"], other[0].stream["infoHash"]])
+
+    def test_load_score_weights(self):
+        defaults = load_score_weights(None)
+        self.assertEqual(load_score_weights('{"size": 0}'), dict(defaults, size=0))
+        for bad in ('{"size": ', '[1]', '{"sizes": 1}', '{"size": "big"}'):
+            self.assertEqual(load_score_weights(bad), defaults)
+
+    def test_load_sonarr_instances(self):
+        instances = load_sonarr_instances([
+            {"name": "4k", "host": "sonarr-4k", "port": 8990, "api_key": "a", "hdr_mode": True},
+            {"name": "anime", "api_key": "b", "banned_words": ["dub"], "hdr_mode": "false"},
+        ])
+        self.assertEqual(list(instances), ["4k", "anime"])
+        self.assertEqual((instances["4k"].host, instances["4k"].port), ("sonarr-4k", 8990))
+        self.assertTrue(instances["4k"].matchers["allow_hdr"])
+        self.assertIsNone(instances["4k"].matchers["banned"])
+        self.assertFalse(instances["anime"].matchers["allow_hdr"])
+        self.assertTrue(instances["anime"].matchers["banned"].search("Show [dub]"))
+        # Different filters never share cached candidates
+        self.assertNotEqual(filter_key(["1080p"], instances["4k"].matchers), filter_key(["1080p"], instances["anime"].matchers))
+        with self.assertRaises(ValueError):
+            load_sonarr_instances([{"name": "4k", "api_key": "a"}, {"name": "4k", "api_key": "b"}])
+        for bad in ({"name": "4k"}, [{"api_key": "a"}], [{"name": "4k", "api_key": "a", "port": "high"}], ["4k"]):
+            with self.assertRaises(ValueError):
+                load_sonarr_instances(bad)
+        with patch.dict(os.environ, {"SONARR_INSTANCES": '[{"name": '}), self.assertRaisesRegex(ValueError, "valid JSON"):
+            load_sonarr_instances()
+
+    @patch('main.loop_episodes')
+    def test_backlog_skips_instances_that_arent_configured(self, mock_loop):
+        insert_episode({"id": 1, "series": {"title": "Show"}, "seasonNumber": 1, "episodeNumber": 1, "has_downloaded": False})
+        insert_episode({"id": 2, "instance": "4k", "series": {"title": "Show"}, "seasonNumber": 1, "episodeNumber": 2, "has_downloaded": False})
+        instances = load_sonarr_instances([{"name": "4k", "api_key": "a"}])
+        with patch('main._sonarr_instances', instances):
+            asyncio.run(check_for_torrents())
+        self.assertEqual([episode["id"] for episode in mock_loop.call_args[0][0]], [2])
+
+    def test_episode_ids_are_per_instance(self):
+        insert_episode({"id": 1, "instance": "4k", "series": {"title": "Show"}, "seasonNumber": 1, "episodeNumber": 1})
+        insert_episode({"id": 1, "instance": "anime", "series": {"title": "Other"}, "seasonNumber": 1, "episodeNumber": 1})
+        self.assertEqual(len(load_episodes()), 2)
+        mark_downloaded([1], instance="4k")
+        self.assertTrue(is_downloaded(1, instance="4k"))
+        self.assertFalse(is_downloaded(1, instance="anime"))
+        self.assertEqual(find_episode(1, instance="anime")["series"]["title"], "Other")
+        self.assertIsNone(find_episode(1))
+
+    @patch('main.update_library')
+    def test_library_refresh_waits_for_mount_and_coalesces(self, mock_update):
+        first = {"id": 1, "series": {"title": "Show", "path": "/tv/Show"}}
+        second = {"id": 2, "series": {"title": "Other", "path": "/tv/Other"}}
+        with patch.dict(os.environ, {"JELLYFIN": "true"}), patch('main.RD_MOUNT_PATH', self.tmp.name), \
+                patch('main.LIBRARY_REFRESH_DEBOUNCE', 0):
+            queue_library_refresh([first], "Show.S01E01")
+            queue_library_refresh([second])
+            queue_library_refresh([first], "Show.S01E02")
+            # Show's files aren't on the mount yet, Other had nothing to wait for
+            self.assertEqual(asyncio.run(refresh_ready_libraries()), 1)
+            mock_update.assert_called_once_with(["/tv/Other"])
+            os.makedirs(os.path.join(self.tmp.name, "Show.S01E01"))
+            os.makedirs(os.path.join(self.tmp.name, "Show.S01E02"))
+            self.assertEqual(asyncio.run(refresh_ready_libraries()), 1)
+            mock_update.assert_called_with(["/tv/Show"])
+            self.assertEqual(asyncio.run(refresh_ready_libraries()), 0)
+
+    @patch('main.pooled_request')
+    def test_update_library_scans_only_given_paths(self, mock_request):
+        env = {"JELLYFIN": "true", "JELLYFIN_HOST": "jf", "JELLYFIN_PORT": "8096", "JELLYFIN_API_TOKEN": "t",
+               "PLEX": "true", "PLEX_HOST": "plex", "PLEX_TOKEN": "p", "PLEX_SECTION_ID": "2"}
+        with patch.dict(os.environ, env):
+            update_library(["/tv/Show One", "/tv/Other"])
+        conn = MagicMock()
+        for call in mock_request.call_args_list:
+            call.args[2](conn)
+        jellyfin, plex_first, plex_second = conn.request.call_args_list
+        self.assertEqual(jellyfin.args[1], "/Library/Media/Updated")
+        self.assertEqual([update["Path"] for update in json.loads(jellyfin.args[2])["Updates"]], ["/tv/Show One", "/tv/Other"])
+        self.assertEqual(plex_first.args[1], "/library/sections/2/refresh?path=/tv/Show%20One")
+        self.assertEqual(plex_second.args[1], "/library/sections/2/refresh?path=/tv/Other")
+        self.assertEqual(mock_request.call_args_list[1].args[:2], ("plex", 32400))
+
+    def test_backlog_priority_and_slow_lane(self):
+        def aired(days):
+            return (datetime.now(timezone.utc) - timedelta(days=days)).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+        series = {"title": "Show"}
+        old = {"id": 1, "series": series, "seasonNumber": 1, "episodeNumber": 1, "airDateUtc": aired(30)}
+        recent = {"id": 2, "series": series, "seasonNumber": 1, "episodeNumber": 2, "airDateUtc": aired(1)}
+        failing = {"id": 3, "series": series, "seasonNumber": 1, "episodeNumber": 3, "airDateUtc": aired(0)}
+        for episode in (old, recent, failing):
+            insert_episode(episode)
+        self.assertEqual([e["id"] for e in load_backlog()], [3, 2, 1])
+
+        # Every failure pushes an episode back a week of air date
+        record_search(failing, False)
+        self.assertEqual([e["id"] for e in load_backlog()], [2, 3, 1])
+
+        # Enough failures and it's only due again after the slow interval, unless it only just aired
+        for _ in range(BACKLOG_SLOW_AFTER - 1):
+            record_search(failing, False)
+        for _ in range(BACKLOG_SLOW_AFTER):
+            record_search(old, False)
+        self.assertEqual([e["id"] for e in load_backlog()], [2, 3])
+        later = time.time() + BACKLOG_SLOW_INTERVAL + 1
+        self.assertEqual([e["id"] for e in load_backlog(now=later)], [2, 3, 1])
+
+        mark_pending([3])
+        self.assertEqual([e["id"] for e in load_backlog()][0], 3)
+
+    @patch('main.fetch_quality_profile', return_value=({"items": [{"allowed": True, "items": [], "quality": {"name": "WEBDL-1080p"}}]}, None))
+    @patch('main.check_torrentio', side_effect=torrentio_reply([]))
+    def test_cached_empty_answer_isnt_a_failure(self, mock_torrentio, mock_profile):
+        aired = (datetime.now(timezone.utc) - timedelta(days=30)).strftime("%Y-%m-%dT%H:%M:%SZ")
+        episode = {"id": 1, "series": {"title": "Show", "imdbId": "tt1", "qualityProfileId": 1},
+                   "seasonNumber": 1, "episodeNumber": 1, "airDateUtc": aired, "has_downloaded": False}
+        insert_episode(dict(episode))
+        refresh_profile_cache()
+        for _ in range(3):
+            asyncio.run(process_episode(dict(episode)))
+        mock_torrentio.assert_called_once()
+        self.assertEqual(get_store().execute("SELECT failures FROM episodes WHERE id = 1").fetchone(), (1,))
+
+        # The season pack search makes the request the search for the first episode is answered from, so it counts it
+        season = [dict(episode, id=n, seasonNumber=2, episodeNumber=n) for n in (2, 3, 4)]
+        insert_episodes([dict(other) for other in season])
+        with patch('main.SEASON_PACK_MIN_EPISODES', 3):
+            asyncio.run(loop_episodes(season))
+        self.assertEqual(mock_torrentio.call_count, 4)
+        failures = get_store().execute("SELECT id, failures FROM episodes WHERE id > 1 ORDER BY id").fetchall()
+        self.assertEqual(failures, [(2, 1), (3, 1), (4, 1)])
+
+    @patch('main.process_episode')
+    def test_loop_episodes_stops_at_budget(self, mock_process):
+        async def search(episode):
+            inc_counter("cache_requests_total", cache="torrentio", result="miss")
+            return False
+
+        mock_process.side_effect = search
+        data = [{"id": n, "series": {"title": "Show", "imdbId": f"tt{n}"}, "seasonNumber": 1, "episodeNumber": n, "has_downloaded": False}
+                for n in range(20)]
+        with patch('main.MAX_WORKERS', 1):
+            asyncio.run(loop_episodes(data, budget=5))
+        self.assertEqual(mock_process.call_count, 5)
+
 
 if __name__ == '__main__':
     unittest.main()